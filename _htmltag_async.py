@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2014 Liftoff Software Corporation
+#
+# For license information see LICENSE.txt
+"""
+The asyncio parts of :mod:`htmltag` (:meth:`~htmltag.HTML.aiter_chunks` and
+:meth:`~htmltag.HTML.write_to`).  They live here because `async def`
+generators are a syntax error before Python 3.6; `htmltag` only imports this
+module when it's running on something newer.
+"""
+async def aiter_chunks(self, chunk_size=65536, encoding=None):
+    """
+    .. versionadded:: 1.8.0
+
+    An asynchronous version of :meth:`render_iter`:  Yields the same
+    chunks, giving control back to the event loop after each one so that
+    rendering a huge document won't block other tasks for long::
+
+        >>> import asyncio
+        >>> from htmltag import TagWrap
+        >>> ul = TagWrap('ul', lazy=True)
+        >>> li = ul.copy('li')
+        >>> async def chunks():
+        ...     html = ul(li(str(i)) for i in range(3))
+        ...     return [chunk async for chunk in html.aiter_chunks(16)]
+        >>> loop = asyncio.new_event_loop()
+        >>> for chunk in loop.run_until_complete(chunks()):
+        ...     print(chunk)
+        <ul><li>0</li><l
+        i>1</li><li>2</l
+        i></ul>
+        >>> loop.close()
+    """
+    import asyncio # Only when it's needed (it takes a while to import)
+    for chunk in self.render_iter(chunk_size, encoding):
+        yield chunk
+        await asyncio.sleep(0)
+
+async def write_to(self, writer, chunk_size=65536, encoding='utf-8'):
+    """
+    .. versionadded:: 1.8.0
+
+    Writes the rendered HTML to *writer* (e.g. an `asyncio.StreamWriter`)
+    in chunks of (at most) *chunk_size* characters encoded using
+    *encoding*, waiting on `writer.drain()` after each one so that slow
+    clients won't cause the whole document to pile up in memory::
+
+        >>> import asyncio
+        >>> from htmltag import TagWrap
+        >>> class Writer(object):
+        ...     def __init__(self):
+        ...         self.data = []
+        ...     def write(self, data):
+        ...         self.data.append(data)
+        ...     async def drain(self):
+        ...         pass
+        >>> writer = Writer()
+        >>> p = TagWrap('p', lazy=True)
+        >>> loop = asyncio.new_event_loop()
+        >>> loop.run_until_complete(
+        ...     p('Hello ', 'async', ' world').write_to(writer, 8))
+        >>> loop.close()
+        >>> writer.data
+        [b'<p>Hello', b' async w', b'orld</p>']
+
+    If *encoding* is `None` the chunks will be written as-is (strings).
+    """
+    async for chunk in self.aiter_chunks(chunk_size, encoding):
+        writer.write(chunk)
+        await writer.drain()
+
+if __name__ == "__main__":
+    # NOTE: Execute `python _htmltag_async.py -v` to run the doctests.
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for htmltag's hot paths.  Usage::
+
+    python benchmarks/bench.py                  # Run everything, compare to baseline.json
+    python benchmarks/bench.py nested escape    # Only run some scenarios
+    python benchmarks/bench.py -o results.json  # Also save the results
+    python benchmarks/bench.py --save-baseline  # Make these results the new baseline
+    python benchmarks/bench.py --sizes          # Also show how big the output is
+
+Each scenario is timed using `timeit` (best of *--repeat* runs) and reported
+in microseconds per call.  When a baseline is available any scenario that got
+slower by more than *--threshold* (a fraction; 0.25 means 25%) is reported as
+a regression and the exit status will be 1.
+
+.. note:: Timings are only comparable when taken on the same machine (and
+    Python) as the baseline; re-run with `--save-baseline` after switching.
+"""
+from __future__ import print_function, unicode_literals
+
+import os, sys, json, timeit, platform, argparse, subprocess
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT) # Always benchmark the htmltag in this checkout
+
+import htmltag
+from htmltag import TagWrap, strip_xss
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+SCENARIOS = OrderedDict()
+
+def scenario(number, timed=False):
+    """
+    Registers the decorated function as a scenario that will be timed
+    *number* times per run.  The function must return the callable to time
+    (so it can do any setup work beforehand).  If *timed* is `True` the
+    callable does its own timing and returns the elapsed time in seconds.
+    """
+    def decorator(func):
+        SCENARIOS[func.__name__] = (func, number, timed)
+        return func
+    return decorator
+
+@scenario(200)
+def flat():
+    "A <ul> with 500 <li> children."
+    ul, li = TagWrap('ul'), TagWrap('li')
+    items = ['Item number %s' % i for i in range(500)]
+    return lambda: ul(*[li(item) for item in items])
+
+@scenario(500)
+def nested():
+    "100 levels of nested <div> tags."
+    div = TagWrap('div')
+    def build():
+        html = 'innermost'
+        for i in range(100):
+            html = div(html, _class='level')
+        return html
+    return build
+
+@scenario(200)
+def escape():
+    "Escaping ~100KB of text full of special characters."
+    text = 'Tom & Jerry say "<hello>" & \'goodbye\'\n' * 2500
+    wrapper = TagWrap('pre')
+    return lambda: wrapper.escape(text)
+
+@scenario(2000)
+def attributes():
+    "A tag with lots of attributes (including data-* ones)."
+    a = TagWrap('a')
+    attrs = dict(('data_field%s' % i, 'value "%s"' % i) for i in range(20))
+    attrs.update(href='/some/where?a=1&b=2', _class='link', title='Go <there>')
+    return lambda: a('Link', **attrs)
+
+@scenario(100)
+def hostile():
+    "strip_xss() on ~40KB of mostly-malicious markup."
+    payload = (
+        '<p>Hi</p><script>alert(1)</script><img src=x onerror="alert(2)">'
+        '<a href="javascript:alert(3)">x</a><iframe src=//evil></iframe>'
+        '<em onmouseover=alert(4)>y</em><b>bold</b><<script>>&lt;script'
+    ) * 200
+    return lambda: strip_xss(payload)
+
+@scenario(20)
+def crafted():
+    "strip_xss() on tags crafted to make a regex backtrack (no closing '>')."
+    payload = '<a' + ' b="x"' * 2000 + '<a b=' * 2000 + '<a b="' * 2000
+    return lambda: strip_xss(payload)
+
+@scenario(20)
+def crafted_policy():
+    "Same as 'crafted' plus ~60KB of unclosed tags under an attributes policy."
+    sanitizer = htmltag.Sanitizer(
+        attributes={'*': ['class'], 'a': ['href']}, schemes=['https'])
+    payload = ('<a' + ' b="x"' * 2000 + '<a b=' * 2000 + '<a b="' * 2000 +
+        '<a' * 10000 + '<a"' * 10000)
+    return lambda: sanitizer.sanitize(payload)
+
+def _benign_tags():
+    "4,000 realistic, harmless tags."
+    tags = ['<a href="https://example.com/items/%s" class="link item-%s" '
+        'title="item number %s">' % (i, i, i) for i in range(1000)]
+    return tags + ['<td>', '</td>', '<span class="x">'] * 1000
+
+@scenario(20)
+def danger_checks():
+    "Sanitizer.is_safe() on 4,000 benign tags."
+    is_safe, tags = htmltag.Sanitizer.get("off").is_safe, _benign_tags()
+    return lambda: [is_safe(tag) for tag in tags]
+
+@scenario(200)
+def safe_mode():
+    "Building a small table of user-supplied (hostile) strings in safe mode."
+    table = TagWrap('table', safe_mode=True)
+    tr, td = table.copy('tr'), table.copy('td')
+    cells = ['<b>ok</b> <script>no</script> %s' % i for i in range(10)]
+    return lambda: table(*[tr(*[td(c) for c in cells]) for i in range(20)])
+
+@scenario(200)
+def append():
+    "Calling HTML.append() 200 times in a row."
+    li = TagWrap('li')
+    items = [li('Item %s' % i) for i in range(200)]
+    def build():
+        html = TagWrap('ul')()
+        for item in items:
+            html = html.append(item)
+        return html
+    return build
+
+@scenario(2000)
+def template():
+    "A compiled three-tag template (see htmltag.compile) with hostile values."
+    div, h2, p = TagWrap('div'), TagWrap('h2'), TagWrap('p')
+    card = htmltag.compile(
+        lambda title, body: div(h2(title), p(body), _class='card'))
+    return lambda: card('Tom & Jerry <3', 'Say "hello" & <goodbye>')
+
+@scenario(2000)
+def cached():
+    "A cache hit on an @htmltag.cached sidebar with 50 links."
+    ul = TagWrap('ul')
+    li, a = ul.copy('li'), ul.copy('a')
+    @htmltag.cached(ttl=60)
+    def sidebar(section):
+        return ul(*[li(a('Link %s' % i, href='/%s/%s' % (section, i)))
+            for i in range(50)], _class='sidebar')
+    return lambda: sidebar('docs')
+
+def _report_rows():
+    "Rows for the table scenarios: 200 rows of mixed strings and numbers."
+    return [['Item <%s>' % i, i, i * 0.25, 'In stock' if i % 3 else 'Sold out',
+        'https://example.com/items/%s' % i] for i in range(200)]
+
+@scenario(50)
+def table():
+    "render_table() with 200 rows and per-column attributes."
+    rows, attrs = _report_rows(), [{}, {'align': 'right'}, {'align': 'right'},
+        {'_class': 'status'}, {'_class': 'link'}]
+    headers = ['Name', 'Qty', 'Price', 'Status', 'URL']
+    return lambda: htmltag.render_table(
+        rows, headers=headers, cell_attrs=attrs, _class='report')
+
+@scenario(50)
+def table_compact():
+    "Same as 'table' but using a compact=True wrapper."
+    rows, attrs = _report_rows(), [{}, {'align': 'right'}, {'align': 'right'},
+        {'_class': 'status'}, {'_class': 'link'}]
+    headers = ['Name', 'Qty', 'Price', 'Status', 'URL']
+    wrapper = TagWrap('table', compact=True)
+    return lambda: htmltag.render_table(rows, headers=headers,
+        cell_attrs=attrs, wrapper=wrapper, _class='report')
+
+@scenario(200)
+def compact():
+    "Same as 'flat' using compact=True tags."
+    ul = TagWrap('ul', compact=True)
+    li = ul.copy('li')
+    items = ['Item number %s' % i for i in range(500)]
+    return lambda: ul(*[li(item) for item in items])
+
+@scenario(20)
+def diff():
+    "htmltag.diff() between two 200-row keyed tables (a few cells changed)."
+    table = TagWrap('table', lazy=True)
+    tbody, tr, td = table.copy('tbody'), table.copy('tr'), table.copy('td')
+    def build(rows):
+        return table(tbody(*[tr(*[td(value) for value in row[1:]],
+            key=row[0]) for row in rows]), _class='live')
+    rows = [[i, 'Item %s' % i, str(i), str(i * 0.5)] for i in range(200)]
+    changed = [list(row) for row in rows]
+    for i in (3, 50, 120, 199):
+        changed[i][2] = 'sold'
+    old, new = build(rows), build(changed)
+    return lambda: htmltag.diff(old, new)
+
+@scenario(10, timed=True)
+def cold_import():
+    "'import htmltag' in a fresh interpreter (startup not included)."
+    code = (
+        'import sys, time; sys.path.insert(0, %r); start = time.time(); '
+        'import htmltag; print(time.time() - start)' % ROOT)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    return lambda: float(subprocess.check_output(
+        [sys.executable, '-c', code], env=env))
+
+def measure(name, repeat):
+    """
+    Returns the best time (in microseconds per call) for the scenario with
+    the given *name* out of *repeat* runs.
+    """
+    func, number, timed = SCENARIOS[name]
+    if timed: # It measures itself
+        call = func()
+        runs = [sum(call() for i in range(number)) for r in range(repeat)]
+    else:
+        runs = timeit.Timer(func()).repeat(repeat=repeat, number=number)
+    return round(min(runs) / number * 1e6, 2)
+
+def size(name):
+    """
+    Returns the size (in bytes, UTF-8 encoded) of what the scenario with the
+    given *name* produces or `None` if it doesn't produce any HTML.
+    """
+    func, number, timed = SCENARIOS[name]
+    if timed:
+        return None
+    html = func()()
+    if not hasattr(html, '__html__'):
+        return None
+    return len(html.encode('utf-8'))
+
+def compare(results, baseline, threshold):
+    """
+    Prints how *results* compare to *baseline* and returns a list of the
+    scenarios that got more than *threshold* slower.
+    """
+    regressions = []
+    for name, usec in results.items():
+        old = baseline.get(name)
+        if not old:
+            print('%-12s %12.1f us  (not in baseline)' % (name, usec))
+            continue
+        change = usec / old - 1
+        flag = ''
+        if change > threshold:
+            flag = '  <-- REGRESSION'
+            regressions.append(name)
+        print('%-12s %12.1f us  %+7.1f%% vs %.1f us%s' % (
+            name, usec, change * 100, old, flag))
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Runs htmltag's benchmarks.")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+        help="Scenarios to run (default: all of them).  Choices: %s" %
+            ", ".join(SCENARIOS))
+    parser.add_argument('-o', '--output', metavar='FILE',
+        help="Save the results (JSON) to FILE.")
+    parser.add_argument('-b', '--baseline', metavar='FILE', default=BASELINE,
+        help="The baseline to compare against (default: %(default)s).")
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+        help="How much slower (as a fraction) a scenario can get before it "
+             "counts as a regression (default: %(default)s).")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help="Number of runs per scenario; the best is used "
+             "(default: %(default)s).")
+    parser.add_argument('--save-baseline', action='store_true',
+        help="Save the results as the new baseline.")
+    parser.add_argument('--sizes', action='store_true',
+        help="Also report the size (in bytes) of each scenario's output.")
+    options = parser.parse_args(args)
+    unknown = [name for name in options.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("Unknown scenario(s): %s" % ", ".join(unknown))
+    names = options.scenarios or list(SCENARIOS)
+    results = OrderedDict(
+        (name, measure(name, options.repeat)) for name in names)
+    baseline = {}
+    if os.path.exists(options.baseline) and not options.save_baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, options.threshold)
+    if options.sizes:
+        print('')
+        for name in names:
+            nbytes = size(name)
+            if nbytes is not None:
+                print('%-12s %12s bytes' % (name, nbytes))
+    output = OrderedDict([
+        ('htmltag', htmltag.__version__),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('units', 'microseconds per call'),
+        ('results', results),
+    ])
+    if options.save_baseline:
+        options.output = options.baseline
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=4)
+            f.write('\n')
+    if regressions:
+        print('\n%s regression(s) beyond %.0f%%: %s' % (
+            len(regressions), options.threshold * 100, ", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -172,26 +172,1155 @@ Lastly, all strings returned by `htmltag` are actually a subclass of `str`:
 This can be extremely useful if you want to be double-sure that no executable
 stuff ends up in your program's output.
 
+Threads and Scoped Settings
+---------------------------
+The tags you import are shared by everything in your program so changing
+their settings (like in the examples above) changes them for everyone,
+including other threads.  To use different settings for a while (in the
+current thread or asyncio task only) use :func:`policy`.  For a tag with
+its own settings make a copy of it::
+
+    >>> from htmltag import policy, b
+    >>> raw_b = b.copy(safe_mode=False)
+    >>> with policy(replacement="(nope)"):
+    ...     print(b(HTML('<i onclick="alert(1)">')))
+    ...     print(raw_b(HTML('<i onclick="alert(1)">')))
+    <b>(nope)</b>
+    <b><i onclick="alert(1)"></b>
+
 
 Functions and Classes
 =====================
 """
 
-import sys, re, cgi, logging
+import sys, re, bisect, logging, threading, weakref
 from types import ModuleType
+from functools import wraps, partial
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    from contextvars import ContextVar
+except ImportError: # Python < 3.7
+    ContextVar = None
+try:
+    from html import unescape as _unescape
+except ImportError: # Python 2
+    from HTMLParser import HTMLParser
+    _unescape = HTMLParser().unescape
 
 if sys.version_info.major == 2:
     stringtype = unicode
+    _string_types = (str, unicode)
+    from time import time as _timer
+    _intern = lambda string: string # intern() only works on byte strings
 else: # Python 3
     stringtype = str
+    _string_types = (str,)
+    from time import perf_counter as _timer
+    _intern = sys.intern
 
 self_closing_tags = set([
     'area', 'base', 'br', 'col', 'command', 'embed', 'hr', 'img', 'input',
     'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr',
 ])
+# Attributes that mean the same thing whether they're given a value or not:
+_boolean_attributes = frozenset([
+    'allowfullscreen', 'async', 'autofocus', 'autoplay', 'checked',
+    'controls', 'default', 'defer', 'disabled', 'formnovalidate', 'hidden',
+    'inert', 'ismap', 'itemscope', 'loop', 'multiple', 'muted', 'nomodule',
+    'novalidate', 'open', 'playsinline', 'readonly', 'required', 'reversed',
+    'selected',
+])
+# Elements whose end tag may be left out (see "Optional tags" in the HTML
+# spec) when they're immediately followed by one of these siblings ('' means
+# they're the last thing in their parent):
+_cells = frozenset(['td', 'th', ''])
+_optional_end_tags = {
+    'li': frozenset(['li', '']),
+    'td': _cells,
+    'th': _cells,
+    'tr': frozenset(['tr', '']),
+    'p': frozenset([
+        'address', 'article', 'aside', 'blockquote', 'details', 'div', 'dl',
+        'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+        'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'main', 'menu',
+        'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul']),
+}
+# What TagWrap.escape() replaces in things that aren't strings:
+_entities = {"&": "&amp;", '<': '&lt;', '>': '&gt;'}
+# Attribute values that don't need to be quoted:
+_unquoted_value_re = re.compile(r'[^\s"\'=<>`]+\Z')
 FILE = __file__
 
-def strip_xss(html, whitelist=None, replacement="(removed)"):
+# Everything that makes a tag dangerous no matter what the policy is, checked
+# in a single pass (see Sanitizer.is_safe()):  JavaScript (and VBScript for
+# IE) URLs, Flash's fscommand, the super obscure seeksegmenttime, and
+# on<whatever>= events.  Every branch starts with a plain string (the 'on'
+# one checks for the whitespace in front with a lookbehind) so the regex
+# engine can skip straight to the places where one of them could match.
+_dangers_re = re.compile(
+    r'javascript:|vbscript:|fscommand|seeksegmenttime|on(?<=\son)[a-z]+\s*=')
+# Each attribute (name and value) in a tag (see Sanitizer._attributes_ok()).
+# Browsers allow just about anything in a name and a '/' between attributes:
+_attribute_re = re.compile(
+    r'[\s/]+([^\s"\'>/=]+)'
+    r'(?:\s*=\s*(?:"([^"\n]*)"|\'([^\'\n]*)\'|([^\'">\s]+)))?')
+# ...and what has to be left after the last one:
+_tag_end_re = re.compile(r'[\s/]*>\Z')
+# The name of a tag (the way a browser sees it):
+_tag_name_re = re.compile(r'<\/?([^\s/>]*)')
+# What a browser will take for the start of a tag:
+_browser_tag_re = re.compile(r'<\/?[A-Za-z]')
+_utf8_browser_tag_re = re.compile(br'<\/?[A-Za-z]')
+# The scheme at the start of a URL (once control characters are removed)
+_url_scheme_re = re.compile(r'([a-z][a-z0-9+.\-]*):')
+_control_chars_re = re.compile(r'[\x00-\x20]+')
+# This matches the start of anything that could (still) become a tag
+_tag_start_re = re.compile(r'<\/?(?:\w|\Z)')
+# Held while Sanitizer.get() creates a new shared instance
+_sanitizers_lock = threading.Lock()
+# Subclasses of HTML for each tagname (see HTML._variant()).  The ones for
+# each sanitized_by are kept by the Sanitizer itself (in _html_variants).
+_html_variants = {}
+
+class _LocalVar(threading.local):
+    """
+    A stand-in for `contextvars.ContextVar` (Python 3.7+) that's scoped to
+    the current thread instead of the current context.
+    """
+    def __init__(self, name, default=None):
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+# The TagWrap settings overridden by policy() as a (key, settings) tuple:
+_overrides = (ContextVar or _LocalVar)('htmltag_overrides', default=None)
+
+class _TagFinder(object):
+    r"""
+    Finds HTML tags; the same ones this regular expression would::
+
+        <\/?\w+((\s+\w+(\s*=\s*(?:".*?"|'.*?'|[^'">\s]+))?)+\s*|\s*)\/?>
+
+    ...but without the backtracking:  A regex engine can end up trying every
+    possible way of closing each quoted attribute value (and retrying all of
+    that from every '<' that follows) which can take forever on malicious
+    input.  Instead we walk the attributes one at a time (*ws*, *word*, and
+    *value* are functions that return where the whitespace, name, or
+    unquoted value starting at a given position ends; see :func:`_atom`).
+    Everything about where a tag ends only depends on where the current
+    attribute ends so that gets remembered for each position we've looked
+    at; no position (or quote) in *html* gets examined more than once no
+    matter how many tags start before it.  That makes it linear time.
+
+    Since that's a lot slower than a regex for regular (non-malicious) tags
+    the *next_tag* pattern gets used to find them first.  It's the same as the
+    above except quoted values always end at the first matching quote (which
+    is what the regex tries first too) so it can't backtrack much.  If that
+    doesn't work out it matches just the start of what might be a tag (the
+    first group) instead and we take it from there (*tag_open* matches the
+    '<' or '</' in front of a tag name).  It's only used for tags that start
+    after everything we've examined so far.
+
+    The patterns, functions, and characters are parameters so the same code
+    can be used for `str` and (UTF-8 encoded) `bytes`.  *word* is used for
+    attribute names and (unless *name* is given) tag names; *sep* (*ws* if
+    not given) for what comes before each attribute.
+    """
+    def __init__(self, next_tag, tag_open, ws, word, value, quotes, newline,
+                 gt, slash, eq, name=None, sep=None):
+        self.next_tag = next_tag
+        self.tag_open = tag_open
+        self.ws = ws
+        self.word = word
+        self.value = value
+        self.quotes = quotes
+        self.newline = newline
+        self.gt = gt
+        self.slash = slash
+        self.eq = eq
+        self.name = name
+        self.sep = sep
+
+    def finditer(self, html):
+        """
+        Yields ``(start, end)`` for each tag in *html* (in order).
+        """
+        memo = {}
+        examined = 0 # Everything before this is in memo (or doesn't matter)
+        next_tag, tag_open = self.next_tag.search, self._open
+        pos = 0
+        while True:
+            if pos >= examined:
+                match = next_tag(html, pos)
+                if match is None:
+                    return
+                if not match.lastindex: # The easy way worked
+                    pos = match.end()
+                    yield (match.start(), pos)
+                    continue
+                pos = match.start()
+            found = tag_open(html, pos)
+            if found is None:
+                return
+            start, name_end = found
+            end, furthest = self._end(html, name_end, memo)
+            examined = max(examined, furthest)
+            if end < 0: # Not a tag after all
+                pos = start + 1
+                continue
+            yield (start, end)
+            pos = end
+
+    def _open(self, html, pos):
+        """
+        Returns a tuple containing the start of the next thing that looks
+        like the beginning of a tag ('<' or '</' followed by a name) in
+        *html* (at or after *pos*) and where its name ends.  Returns `None`
+        if there aren't any.
+        """
+        search, word = self.tag_open.search, self.name or self.word
+        while True:
+            match = search(html, pos)
+            if match is None:
+                return None
+            end = word(html, match.end())
+            if end > match.end():
+                return (match.start(), end)
+            pos = match.start() + 1
+
+    def _close(self, html, quote):
+        """
+        Returns the position of the next *quote* character in *html* after
+        the one at position *quote* (on the same line) or -1 if there isn't
+        one.
+        """
+        char = html[quote:quote+1]
+        close = html.find(char, quote + 1)
+        if close < 0 or html.find(self.newline, quote + 1, close) >= 0:
+            return -1
+        return close
+
+    def _end(self, html, x, memo):
+        """
+        Returns a tuple containing where the tag whose name ends at position
+        *x* ends (or -1 if it doesn't) and the furthest position that was
+        examined to find that out.  *memo* holds the results for positions
+        that have already been examined (quotes are stored under
+        ``-1 - position``).
+        """
+        ws, word, value = self.ws, self.word, self.value
+        sep = self.sep or ws
+        quotes, gt, slash, eq = self.quotes, self.gt, self.slash, self.eq
+        # Positions whose result will be the same as the one we're working
+        # out and (when waiting to find out if a tag can end after a quoted
+        # value) the ones whose result depends on it:
+        keys = []
+        waiting = []
+        furthest = x
+        while True:
+            while True: # Walk forward until we know how this tag ends
+                result = memo.get(x)
+                if result is not None:
+                    break
+                keys.append(x)
+                y = sep(html, x)
+                furthest = max(furthest, y)
+                char = html[y:y+1]
+                if char == gt:
+                    result = y + 1
+                    break
+                if char == slash:
+                    result = y + 2 if html[y+1:y+2] == gt else -1
+                    break
+                x = word(html, y) if y > x else y
+                if x == y: # Not an attribute
+                    result = -1
+                    break
+                y = ws(html, x)
+                if html[y:y+1] != eq:
+                    continue # No value
+                y = ws(html, y + 1)
+                if html[y:y+1] in quotes:
+                    # Try ending the value at the closest matching quote
+                    # first (like .*? would)
+                    close = self._close(html, y)
+                    result = memo.get(-1 - close) if close >= 0 else -1
+                    if result is not None:
+                        break
+                    keys.append(-1 - close)
+                    waiting.append(keys)
+                    keys = []
+                    x = close + 1
+                    continue
+                x = value(html, y)
+                if x == y: # No value after the '='
+                    result = -1
+                    break
+            while True: # Hand the result back to whoever was waiting for it
+                for key in keys:
+                    memo[key] = result
+                if not waiting:
+                    return (result, max(furthest, result))
+                keys = waiting.pop()
+                if result >= 0:
+                    continue
+                # The tag didn't work out when the quoted value ended at that
+                # quote; try the next one.
+                close = self._close(html, -1 - keys[-1])
+                result = memo.get(-1 - close) if close >= 0 else -1
+                if result is None:
+                    keys.append(-1 - close)
+                    waiting.append(keys)
+                    keys = []
+                    x = close + 1
+                    break
+
+def _atom(pattern):
+    """
+    Returns a function that returns where the run of characters matched by
+    *pattern* (which must be able to match nothing) starting at a given
+    position in a string ends.
+    """
+    match = re.compile(pattern).match
+    return lambda html, pos: match(html, pos).end()
+
+def _name_atom(word, rest):
+    """
+    Returns an atom (see :func:`_atom`) for names that start with at least
+    one *word* character followed by anything the *rest* atom allows.
+    """
+    def end(html, pos):
+        x = word(html, pos)
+        return rest(html, x) if x > pos else pos
+    return end
+
+def _utf8_atom(pattern, test):
+    """
+    Like :func:`_atom` but for UTF-8 encoded `bytes`:  *pattern* only needs to
+    deal with ASCII.  When it stops at a multi-byte character that character
+    (just that one) gets decoded and included in the run if *test(character)*
+    returns `True`.  That way the results are the same as they'd be for the
+    decoded string.
+    """
+    match = re.compile(pattern).match
+    def end(data, pos):
+        while True:
+            pos = match(data, pos).end()
+            lead = data[pos:pos+1]
+            if not lead or lead < b'\xc0': # End of the run (or data)
+                return pos
+            size = 2 if lead < b'\xe0' else 3 if lead < b'\xf0' else 4
+            try:
+                char = data[pos:pos+size].decode('utf-8')
+            except UnicodeDecodeError:
+                return pos
+            if not test(char):
+                return pos
+            pos += size
+    return end
+
+_tag_finder = _TagFinder(
+    next_tag=re.compile(
+        r"<\/?\w+(?:\s+\w+(?:\s*=\s*(?:\"[^\"\n]*\"|'[^'\n]*'|[^'\">\s]+))?)*"
+        r"\s*\/?>|(<\/?\w+)"),
+    tag_open=re.compile(r'<\/?(?=\w)'),
+    ws=_atom(r'\s*'),
+    word=_atom(r'\w*'),
+    value=_atom(r'[^\'">\s]*'),
+    quotes=('"', "'"),
+    newline='\n',
+    gt='>',
+    slash='/',
+    eq='=',
+)
+
+# The same thing for UTF-8 encoded bytes.  The ASCII characters that \s and
+# \w match when dealing with (unicode) strings:
+_ascii_ws = r'[\t\n\x0b\x0c\r\x1c-\x20]'
+_ascii_word = r'[A-Za-z0-9_]'
+_utf8_tag_finder = _TagFinder(
+    # Anything that isn't ASCII has to go the long way (below)
+    next_tag=re.compile((
+        r"<\/?{w}+(?:{s}+{w}+(?:{s}*={s}*(?:\"[^\"\n]*\"|'[^'\n]*'|"
+        r"[^'\">\t\n\x0b\x0c\r\x1c-\x20\x80-\xff]+))?)*{s}*\/?>|"
+        r"(<\/?[A-Za-z0-9_\x80-\xff])").format(
+            s=_ascii_ws, w=_ascii_word).encode('ascii')),
+    tag_open=re.compile(br'<\/?(?=[A-Za-z0-9_\x80-\xff])'),
+    ws=_utf8_atom((_ascii_ws + '*').encode('ascii'), stringtype.isspace),
+    word=_utf8_atom((_ascii_word + '*').encode('ascii'),
+        lambda char: char.isalnum() or char == '_'),
+    value=_utf8_atom(br'[^\'">\t\n\x0b\x0c\r\x1c-\x20\x80-\xff]*',
+        lambda char: not char.isspace()),
+    quotes=(b'"', b"'"),
+    newline=b'\n',
+    gt=b'>',
+    slash=b'/',
+    eq=b'=',
+)
+
+# Finders for sanitizers with an attributes or schemes policy.  Those need to
+# see every tag the way a browser would (e.g. '<img/src=x data-a=b>') so names
+# can contain anything that doesn't end them and attributes can be separated
+# by '/'.  Unquoted values can't contain a '/' in the quick pattern (it'd be
+# ambiguous; the long way takes care of those).  Tag names stop at a '<' (a
+# browser wouldn't) so they can't run on into the next tag; otherwise every
+# '<' would mean rescanning everything after it.  A tag like that ends up
+# being rejected anyway (see Sanitizer._tags()).
+_strict_tag_finder = _TagFinder(
+    next_tag=re.compile(
+        r"<\/?\w[^\s/><]*(?:[\s/]+[^\s\"'>/=]+(?:\s*=\s*(?:\"[^\"\n]*\"|"
+        r"'[^'\n]*'|[^'\">\s/]+))?)*[\s/]*>|(<\/?\w)"),
+    tag_open=re.compile(r'<\/?(?=\w)'),
+    ws=_atom(r'\s*'),
+    word=_atom(r'[^\s"\'>/=]*'),
+    value=_atom(r'[^\'">\s]*'),
+    quotes=('"', "'"),
+    newline='\n',
+    gt='>',
+    slash='/',
+    eq='=',
+    name=_name_atom(_atom(r'\w*'), _atom(r'[^\s/><]*')),
+    sep=_atom(r'[\s/]*'),
+)
+_ascii_ws_chars = r'\t\n\x0b\x0c\r\x1c-\x20'
+_not_space = lambda char: not char.isspace()
+_strict_utf8_tag_finder = _TagFinder(
+    next_tag=re.compile((
+        r"<\/?{w}[^{s}/><\x80-\xff]*(?:[{s}/]+[^{s}\"'>/=\x80-\xff]+"
+        r"(?:[{s}]*=[{s}]*(?:\"[^\"\n]*\"|'[^'\n]*'|[^'\">{s}/\x80-\xff]+))?)*"
+        r"[{s}/]*>|(<\/?[A-Za-z0-9_\x80-\xff])").format(
+            s=_ascii_ws_chars, w=_ascii_word).encode('ascii')),
+    tag_open=re.compile(br'<\/?(?=[A-Za-z0-9_\x80-\xff])'),
+    ws=_utf8_atom((_ascii_ws + '*').encode('ascii'), stringtype.isspace),
+    word=_utf8_atom((r'[^%s"\'>/=\x80-\xff]*' % _ascii_ws_chars).encode(
+        'ascii'), _not_space),
+    value=_utf8_atom(br'[^\'">\t\n\x0b\x0c\r\x1c-\x20\x80-\xff]*', _not_space),
+    quotes=(b'"', b"'"),
+    newline=b'\n',
+    gt=b'>',
+    slash=b'/',
+    eq=b'=',
+    name=_name_atom(
+        _utf8_atom((_ascii_word + '*').encode('ascii'),
+            lambda char: char.isalnum() or char == '_'),
+        _utf8_atom((r'[^%s/><\x80-\xff]*' % _ascii_ws_chars).encode('ascii'),
+            _not_space)),
+    sep=_utf8_atom((r'[%s/]*' % _ascii_ws_chars).encode('ascii'),
+        stringtype.isspace),
+)
+
+class _TracingFinder(_TagFinder):
+    """
+    A :class:`_TagFinder` that keeps track of which parts of the HTML it had
+    to look at (see :class:`Template`).  `looked` holds the ``(start, end)``
+    ranges that were examined as markup (names, whitespace, values, etc) and
+    `skimmed` the ones that were only searched for a closing quote.
+    """
+    def __init__(self, finder):
+        self.__dict__.update(finder.__dict__)
+        self.looked = []
+        self.skimmed = []
+        self.ws = self._watch(finder.ws)
+        self.word = self._watch(finder.word)
+        self.value = self._watch(finder.value)
+
+    def _watch(self, atom):
+        """
+        Returns *atom* wrapped so that what it examines (including the
+        character it stopped at) gets recorded in `looked`.
+        """
+        looked = self.looked
+        def watched(html, pos):
+            end = atom(html, pos)
+            looked.append((pos, end + 1))
+            return end
+        return watched
+
+    def _close(self, html, quote):
+        close = _TagFinder._close(self, html, quote)
+        self.skimmed.append((quote + 1, close + 1 if close >= 0 else len(html)))
+        return close
+
+    def tags(self, html):
+        """
+        Returns a list of ``(start, end)`` tuples for each tag in *html* (the
+        same ones :meth:`finditer` finds).  Every possible tag gets examined
+        the long way so that `looked` and `skimmed` are complete.
+        """
+        memo = {}
+        tags = []
+        pos = 0
+        while True:
+            found = self._open(html, pos)
+            if found is None:
+                return tags
+            start, name_end = found
+            end = self._end(html, name_end, memo)[0]
+            if end < 0:
+                pos = start + 1
+                continue
+            tags.append((start, end))
+            pos = end
+
+def _overlaps(ranges, start, end):
+    """
+    Returns `True` if any of the ``(start, end)`` *ranges* overlap the range
+    from *start* to *end*.
+    """
+    return any(a < end and start < b for a, b in ranges)
+
+def _sanitize_with(sanitizer, html):
+    """
+    Returns ``sanitizer.sanitize(html)`` (see :meth:`Sanitizer.map`).
+    """
+    return sanitizer.sanitize(html)
+
+def _browser_tags(html, finder, opener, gt, unparsed):
+    """
+    Yields ``(start, end)`` for each tag *finder* finds in *html* along with
+    everything in between that starts like a tag (*opener*) but didn't turn
+    out to be one.  Those end at the next *gt* (or right after the opener if
+    there isn't one before the next tag) and their starts get added to the
+    *unparsed* set.  See :meth:`Sanitizer._tags`.
+    """
+    search = opener.search
+    last = 0
+    tags = finder.finditer(html)
+    while True:
+        tag = next(tags, None)
+        gap_end = len(html) if tag is None else tag[0]
+        while True:
+            match = search(html, last, gap_end)
+            if match is None:
+                break
+            close = html.find(gt, match.end(), gap_end)
+            last = close + 1 if close >= 0 else match.end()
+            unparsed.add(match.start())
+            yield (match.start(), last)
+        if tag is None:
+            return
+        yield tag
+        last = tag[1]
+
+def _policy_key(attributes, schemes):
+    """
+    Returns a (hashable) tuple representing the given *attributes* and
+    *schemes* policies (see :class:`Sanitizer`).
+    """
+    if attributes is not None:
+        attributes = frozenset(
+            (tag.lower(), frozenset(name.lower() for name in names))
+            for tag, names in attributes.items())
+    if schemes is not None:
+        schemes = frozenset(scheme.lower() for scheme in schemes)
+    return (attributes, schemes)
+
+def _whitelist_key(whitelist):
+    """
+    Returns a frozen copy of *whitelist* if it's a (mutable) list or set so
+    that changes made to it in-place can be noticed later (see
+    :attr:`TagWrap.sanitizer`).  Returns `None` for anything else.
+    """
+    if isinstance(whitelist, (list, set)):
+        return frozenset(whitelist)
+    return None
+
+class Sanitizer(object):
+    """
+    .. versionadded:: 1.8.0
+
+    A reusable XSS-stripping policy.  All the expensive setup that
+    :func:`strip_xss` needs (compiled patterns, the whitelist, the replacement
+    mode) happens once when the `Sanitizer` is created so the same instance can
+    be used over and over again (and shared between any number of
+    :class:`TagWrap` instances).
+
+    :param whitelist: An iterable of allowed tag names.  If not given
+        :attr:`Sanitizer.default_whitelist` will be used.  Use "off" to disable
+        whitelisting altogether.
+    :param replacement: What to replace rejected tags with.  If "entities"
+        rejected tags will be converted into HTML entities.
+    :param attributes: If given only these attributes will be allowed.  A
+        `dict` mapping tag names to the attribute names allowed in them
+        ("*" applies to every tag).
+    :param schemes: If given URLs (in the attributes listed in
+        `url_attributes`) may only use these schemes (e.g. "https").  URLs
+        without a scheme (relative ones) are always allowed.
+
+    Example::
+
+        >>> sanitizer = Sanitizer(replacement="(nope)")
+        >>> html = '<em>Hi!</em><script>alert("pwned!")</script>'
+        >>> html, rejects = sanitizer.sanitize(html)
+        >>> print(html)
+        <em>Hi!</em>(nope)alert("pwned!")(nope)
+        >>> sorted(rejects)
+        ['</script>', '<script>']
+
+    Attributes and URLs can be restricted as well::
+
+        >>> sanitizer = Sanitizer(
+        ...     attributes={'a': ['href', 'title'], '*': ['class']},
+        ...     schemes=['http', 'https', 'mailto'])
+        >>> html = ('<a href="https://example.com/" class="ext">ok</a> '
+        ...         '<a href="ftp://example.com/">no</a> <em style="x">no</em>')
+        >>> print(sanitizer.sanitize(html)[0])
+        <a href="https://example.com/" class="ext">ok</a> (removed)no</a> (removed)no</em>
+
+    Tags are read the way a browser would read them (attribute names can have
+    dashes in them and a '/' works just as well as a space between
+    attributes) and anything that starts like a tag but can't be made sense
+    of is rejected::
+
+        >>> sanitizer = Sanitizer(
+        ...     attributes={'*': ['class'], 'a': ['href'], 'img': ['src']},
+        ...     schemes=['http', 'https'])
+        >>> print(sanitizer.sanitize('<a href="ftp://x" data-x>no</a>')[0])
+        (removed)no</a>
+        >>> print(sanitizer.sanitize('<img src=x data-a=b style="x:y">')[0])
+        (removed)
+        >>> print(sanitizer.sanitize('<img/src=x> <img/style="x:y"/src=x>')[0])
+        <img/src=x> (removed)
+        >>> sanitizer = Sanitizer(attributes={'span': ['data-id']})
+        >>> print(sanitizer.sanitize('<span data-id="7" data-x>!</span>')[0])
+        (removed)!</span>
+        >>> print(sanitizer.sanitize('<span data-id="7">!</span>')[0])
+        <span data-id="7">!</span>
+
+    .. note:: The policy (*whitelist*, *replacement*, *attributes*, and
+        *schemes*) of a `Sanitizer` should be treated as read-only; create a
+        new instance to use a different policy.
+
+    To avoid scanning the same HTML over and over again (e.g. user signatures
+    that show up on every page) set the `cache` attribute to a
+    :class:`SanitizeCache`.  Set `Sanitizer.cache` to use one for all
+    sanitizers (including the ones used by :func:`strip_xss` and
+    :class:`TagWrap`).
+    """
+    # Set this to a SanitizeCache to cache results (see above):
+    cache = None
+    # The attributes that hold URLs (for the *schemes* policy):
+    url_attributes = frozenset([
+        'action', 'background', 'cite', 'classid', 'codebase', 'data',
+        'dynsrc', 'formaction', 'href', 'icon', 'longdesc', 'lowsrc',
+        'manifest', 'poster', 'profile', 'src', 'usemap'
+    ])
+
+    # These are all pretty safe and covers most of what users would want in
+    # terms of formatting and sharing media (images, audio, video, etc).
+    default_whitelist = frozenset([
+        'a', 'abbr', 'aside', 'audio', 'bdi', 'bdo', 'blockquote', 'canvas',
+        'caption', 'code', 'col', 'colgroup', 'data', 'dd', 'del',
+        'details', 'div', 'dl', 'dt', 'em', 'figcaption', 'figure', 'h1',
+        'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li',
+        'mark', 'ol', 'p', 'pre', 'q', 'rp', 'rt', 'ruby', 's', 'samp',
+        'small', 'source', 'span', 'strong', 'sub', 'summary', 'sup',
+        'table', 'td', 'th', 'time', 'tr', 'track', 'u', 'ul', 'var',
+        'video', 'wbr'
+    ])
+
+    def __init__(self, whitelist=None, replacement="(removed)",
+                 attributes=None, schemes=None):
+        if not whitelist:
+            whitelist = self.default_whitelist
+        elif whitelist == "off":
+            whitelist = None # Disable it altogether
+        else:
+            whitelist = frozenset(whitelist)
+        self.whitelist = whitelist
+        self.replacement = replacement
+        # Everything that affects the results (see SanitizeCache):
+        self.policy = (whitelist, replacement) + _policy_key(
+            attributes, schemes)
+        if attributes is not None:
+            attributes = dict(
+                (tag.lower(), frozenset(name.lower() for name in names))
+                for tag, names in attributes.items())
+        self.attributes = attributes
+        if schemes is not None:
+            schemes = frozenset(scheme.lower() for scheme in schemes)
+        self.schemes = schemes
+        self._html_variants = {} # See HTML._variant()
+
+    def __getstate__(self): # Classes made by HTML._variant() can't be pickled
+        state = self.__dict__.copy()
+        del state['_html_variants']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._html_variants = {}
+
+    @classmethod
+    def get(cls, whitelist=None, replacement="(removed)", attributes=None,
+            schemes=None):
+        """
+        Returns a shared `Sanitizer` for the given *whitelist*,
+        *replacement*, *attributes*, and *schemes*, creating it if necessary.
+        Calling this with the same policy returns the same instance (the 256
+        most recently used ones are kept around)::
+
+            >>> Sanitizer.get(['b', 'i']) is Sanitizer.get(('i', 'b'))
+            True
+        """
+        if not whitelist:
+            key = (None, replacement)
+        elif whitelist == "off":
+            key = ("off", replacement)
+        else:
+            key = (frozenset(whitelist), replacement)
+        if attributes is not None or schemes is not None:
+            key += _policy_key(attributes, schemes)
+        sanitizer = _sanitizers.get(key)
+        if sanitizer is None:
+            with _sanitizers_lock: # So every thread gets the same one
+                sanitizer = _sanitizers.get(key)
+                if sanitizer is None:
+                    sanitizer = cls(whitelist, replacement, attributes, schemes)
+                    _sanitizers.set(key, sanitizer)
+        return sanitizer
+
+    def is_safe(self, tag):
+        """
+        Returns `True` if the given *tag* (e.g. '<b class="foo">') is allowed
+        by this policy.
+        """
+        tag_lower = tag.lower()
+        strict = self.attributes is not None or self.schemes is not None
+        if strict: # '/' can separate the name from the attributes too
+            short_tag = _tag_name_re.match(tag_lower).group(1)
+        else:
+            short_tag = tag_lower.split(None, 1)[0].lstrip('</').rstrip('>')
+        if self.whitelist and short_tag not in self.whitelist:
+            return False
+        if _dangers_re.search(tag_lower):
+            return False
+        if strict:
+            return self._attributes_ok(short_tag, tag_lower)
+        return True
+
+    def _attributes_ok(self, short_tag, tag_lower):
+        """
+        Returns `True` if all the attributes in *tag_lower* (a lower-cased
+        tag whose name is *short_tag*) are allowed by our *attributes* and
+        *schemes* policies.  Tags whose attributes can't be made sense of
+        aren't allowed either.
+        """
+        allowed = None
+        if self.attributes is not None:
+            allowed = self.attributes.get(short_tag, frozenset()).union(
+                self.attributes.get('*', ()))
+        schemes = self.schemes
+        pos = len(short_tag) + 1 + tag_lower.startswith('</')
+        while True:
+            match = _attribute_re.match(tag_lower, pos)
+            if match is None:
+                return _tag_end_re.match(tag_lower, pos) is not None
+            pos = match.end()
+            name, value = match.group(1), match.group(2, 3, 4)
+            if allowed is not None and name not in allowed:
+                return False
+            if name.startswith('on'): # Even without whitespace in front
+                return False
+            if schemes is not None and name in self.url_attributes:
+                value = _control_chars_re.sub(
+                    '', _unescape("".join(v for v in value if v)))
+                scheme = _url_scheme_re.match(value)
+                if scheme and scheme.group(1) not in schemes:
+                    return False
+
+    def replace(self, tag):
+        """
+        Returns what the rejected *tag* should be replaced with.
+        """
+        if self.replacement == "entities":
+            return _xmlcharrefs(escape(tag))
+        return self.replacement
+
+    def sanitize(self, html, cache=None):
+        """
+        Returns a tuple containing *html* with all unsafe tags replaced and a
+        `set()` of the tags that were rejected (same as :func:`strip_xss`).
+        The output is built in a single pass over *html*.  If a *cache* (a
+        :class:`SanitizeCache`) is given it will be used instead of `cache`.
+
+        *html* may also be UTF-8 encoded `bytes` (or a `bytearray` or
+        `memoryview`) in which case it gets scanned as-is (without decoding
+        the whole thing first) and the output will be `bytes` too.  The
+        rejected tags are still returned as (decoded) strings.
+        """
+        if isinstance(html, (bytearray, memoryview)):
+            html = bytes(html)
+        html, bad_tags, rest = self._scan(html, cache=cache)
+        return (html, bad_tags)
+
+    def map(self, htmls, processes=None, chunksize=64):
+        """
+        Sanitizes all of the given *htmls* (an iterable of strings), yielding
+        ``(html, rejects)`` tuples (same as :meth:`~Sanitizer.sanitize`) in
+        the same order.  The work is spread over a pool of *processes*
+        (defaults to the number of CPUs) that are given *chunksize* strings at
+        a time.  Results are yielded as soon as they're ready so *htmls* can
+        be as long as you like (e.g. every comment in your database).
+
+        If *processes* is 1 no pool will be used (the results are the same
+        either way).  See :func:`strip_xss_many` for an example.
+        """
+        if processes == 1:
+            for html in htmls:
+                yield self.sanitize(html)
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        # Bound methods can't be pickled in Python 2:
+        sanitize = partial(_sanitize_with, self)
+        try:
+            for result in pool.imap(sanitize, htmls, chunksize):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _scan(self, html, final=True, cache=None):
+        """
+        Does the work for :meth:`~Sanitizer.sanitize`.  Returns a tuple of
+        ``(output, bad_tags, rest)``.
+
+        Unless *final* is `True` scanning stops at the first '<' that looks
+        like the start of a tag but didn't match as one (it still might once
+        more HTML is added after it).  Everything from that point on will be
+        returned unmodified as *rest*.
+
+        The result will come from (and be stored in) *cache* or `cache` if
+        either is set.  Only *final* scans are cached:  Partial ones are
+        just a prefix of a stream that's still arriving so they'd never be
+        seen again.
+        """
+        if cache is None:
+            cache = self.cache
+        if cache is None or not final:
+            return self._scan_html(html, final)
+        key = (self.policy, html)
+        result = cache.get(key)
+        if result is None:
+            result = self._scan_html(html, final)
+            out, bad_tags, rest = result
+            cache.set(key, (out, frozenset(bad_tags), rest))
+            return result
+        out, bad_tags, rest = result
+        return (out, set(bad_tags), rest)
+
+    def _tags(self, html, final, unparsed, utf8=False):
+        """
+        Returns an iterator of ``(start, end)`` tuples for each tag in *html*
+        (`bytes` if *utf8*) that needs to be checked.
+
+        With an *attributes* or *schemes* policy tags get found the way a
+        browser would see them and, if *final*, anything else a browser
+        would take for the start of a tag is included too (otherwise it'd
+        get through unchecked).  The starts of those get added to the
+        *unparsed* set; they can't be allowed since there's no telling
+        what's in them.
+        """
+        if self.attributes is None and self.schemes is None:
+            return (_utf8_tag_finder if utf8 else _tag_finder).finditer(html)
+        finder = _strict_utf8_tag_finder if utf8 else _strict_tag_finder
+        if not final:
+            return finder.finditer(html)
+        if utf8:
+            return _browser_tags(
+                html, finder, _utf8_browser_tag_re, b'>', unparsed)
+        return _browser_tags(html, finder, _browser_tag_re, '>', unparsed)
+
+    def _scan_html(self, html, final):
+        """
+        Does the work for :meth:`~Sanitizer._scan` (without caching).
+        """
+        if bytes is not str and isinstance(html, bytes): # Not Python 2
+            return self._scan_utf8(html, final)
+        bad_tags = set()
+        out = []
+        pos = 0 # Where the next chunk of output starts
+        last = 0 # Where the last tag ended
+        start = None # The first dangling tag-like thing (if not final)
+        unparsed = set()
+        for tag_start, tag_end in self._tags(html, final, unparsed):
+            if not final:
+                start = _tag_start_re.search(html, last)
+                if start.start() < tag_start:
+                    break # Dangling tag-like thing before this tag
+                start = None
+            last = tag_end
+            tag = html[tag_start:tag_end]
+            if tag_start not in unparsed and self.is_safe(tag):
+                continue
+            bad_tags.add(tag)
+            out.append(html[pos:tag_start])
+            out.append(self.replace(tag))
+            pos = tag_end
+        else:
+            if not final:
+                start = _tag_start_re.search(html, last)
+        if start is None:
+            if not bad_tags:
+                return (html, bad_tags, "")
+            out.append(html[pos:])
+            return ("".join(out), bad_tags, "")
+        out.append(html[pos:start.start()])
+        return ("".join(out), bad_tags, html[start.start():])
+
+    def _scan_utf8(self, data, final):
+        """
+        :meth:`~Sanitizer._scan_html` for UTF-8 encoded *data* (`bytes`).
+        Only the tags get decoded (to check them); the rest is copied as-is.
+        Undecodable bytes are passed through (see the 'surrogateescape' error
+        handler) rather than raising an exception.
+        """
+        if not final: # Incremental use only ever involves strings
+            raise ValueError("bytes can only be sanitized all at once")
+        bad_tags = set()
+        out = []
+        pos = 0
+        unparsed = set()
+        for tag_start, tag_end in self._tags(data, final, unparsed, True):
+            tag = data[tag_start:tag_end].decode('utf-8', 'surrogateescape')
+            if tag_start not in unparsed and self.is_safe(tag):
+                continue
+            bad_tags.add(tag)
+            out.append(data[pos:tag_start])
+            out.append(self.replace(tag).encode('utf-8', 'surrogateescape'))
+            pos = tag_end
+        if not bad_tags:
+            return (data, bad_tags, b"")
+        out.append(data[pos:])
+        return (b"".join(out), bad_tags, b"")
+
+def escape(string):
+    """
+    .. versionadded:: 1.8.0
+
+    Returns *string* with all instances of '<', '>', and '&' converted into
+    HTML entities.  If there's nothing to convert *string* itself is returned
+    (no copy is made)::
+
+        >>> print(escape("Fish & Chips <3"))
+        Fish &amp; Chips &lt;3
+        >>> s = "Nothing to see here"
+        >>> escape(s) is s
+        True
+    """
+    if '&' in string or '<' in string or '>' in string:
+        return string.replace(
+            '&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return string
+
+def escape_many(strings):
+    """
+    .. versionadded:: 1.8.0
+
+    Returns a list containing all the given *strings* passed through
+    :func:`escape`.  Useful for escaping a whole column of table cells in one
+    go (the strings get escaped all at once instead of one at a time)::
+
+        >>> escape_many(["1 < 2", "AT&T", "plain"])
+        ['1 &lt; 2', 'AT&amp;T', 'plain']
+    """
+    strings = list(strings)
+    joined = "\x00".join(strings)
+    if joined.count("\x00") != len(strings) - 1: # Can't split it back up
+        return [escape(string) for string in strings]
+    escaped = escape(joined)
+    if escaped is joined:
+        return strings
+    return escaped.split("\x00")
+
+try:
+    _isascii = stringtype.isascii # Python 3.7+
+except AttributeError:
+    _non_ascii_re = re.compile(r'[^\x00-\x7f]')
+    def _isascii(string):
+        return not _non_ascii_re.search(string)
+
+def _xmlcharrefs(string):
+    """
+    Returns *string* with all non-ASCII characters converted into numeric
+    character references (e.g. '&#233;').
+    """
+    if _isascii(string):
+        return string
+    return string.encode('ascii', 'xmlcharrefreplace').decode('ascii')
+
+class _PieceScanner(object):
+    """
+    Runs a :class:`Sanitizer` over HTML that arrives in pieces, appending the
+    results to the *out* list.  Joining *out* together gives the same result
+    as running the sanitizer over all of the pieces joined together.
+
+    Pieces fed in as *trusted* have already been sanitized by the same
+    sanitizer (or can't contain any tags) so they're passed through as-is
+    unless they follow a tag-like thing that hasn't been closed yet (e.g.
+    '<img src="'), in which case they're scanned along with it.  If
+    *sanitizer* is `None` everything is passed through.
+
+    After :meth:`close` the `trusted` attribute tells whether everything in
+    *out* can be considered sanitized (nothing was left dangling) and
+    `rejected` will contain all the tags that were rejected.
+
+    Something that stays dangling (e.g. '<b title="' that never gets its
+    closing quote) would have to be rescanned every time a '>' shows up.  To
+    keep that from taking quadratic time it only gets rescanned once what's
+    been carried along has (at least) doubled in size since the last scan.
+    """
+    __slots__ = ('sanitizer', 'out', 'rejected', 'trusted', '_carry',
+                 '_size', '_scanned', '_closable')
+
+    def __init__(self, sanitizer, out):
+        self.sanitizer = sanitizer
+        self.out = out
+        self.rejected = set()
+        self.trusted = True
+        self._carry = [] # Untrusted text we've yet to output
+        self._size = 0 # How much text is in _carry
+        self._scanned = 0 # ...and how much of it was left over last time
+        self._closable = False # Whether a '>' was added since then
+
+    def feed(self, text, trusted=False):
+        carry = self._carry
+        if not carry:
+            if trusted or not self.sanitizer:
+                self.out.append(text)
+                return
+        carry.append(text)
+        self._size += len(text)
+        if '>' in text:
+            self._closable = True
+        if not self._closable or self._size < 2 * self._scanned:
+            return # Nothing could've been closed (or not worth checking yet)
+        html, bad_tags, rest = self.sanitizer._scan("".join(carry), False)
+        self.rejected.update(bad_tags)
+        if html:
+            self.out.append(html)
+        self._carry = [rest] if rest else []
+        self._size = self._scanned = len(rest)
+        self._closable = False
+
+    def feed_trusted(self, texts):
+        """
+        Feeds a whole list of trusted *texts* at once.
+        """
+        if self._carry:
+            self.feed("".join(texts), True)
+        else:
+            self.out.extend(texts)
+
+    def feed_children(self, children):
+        """
+        Feeds all the *children* (as returned by :meth:`TagWrap._children`).
+        """
+        sanitizer = self.sanitizer
+        for child in _iter_children(children):
+            if isinstance(child, Element):
+                texts, trusted = child._texts(sanitizer)
+                if trusted:
+                    self.feed_trusted(texts)
+                else:
+                    self.feed("".join(texts))
+            else:
+                self.feed(*child)
+
+    def close(self):
+        if self._carry:
+            html, bad_tags, rest = self.sanitizer._scan("".join(self._carry))
+            self.rejected.update(bad_tags)
+            self.out.append(html)
+            self.trusted = False
+            self._carry = []
+            self._size = self._scanned = 0
+
+def _scan_pieces(sanitizer, opening, children, closing):
+    """
+    Feeds the *opening* tag, *children* and *closing* tag (``(text,
+    trusted)`` pieces) through a new :class:`_PieceScanner` and returns it
+    (closed).
+    """
+    scanner = _PieceScanner(sanitizer, [])
+    scanner.feed(*opening)
+    scanner.feed_children(children)
+    if closing[0]:
+        scanner.feed(*closing)
+    scanner.close()
+    return scanner
+
+class _Deferred(object):
+    """
+    A placeholder for an iterator that was passed to a lazy :class:`TagWrap`.
+    Its items won't be consumed until the element it belongs to is rendered.
+    """
+    __slots__ = ('iterator', 'wrapper', 'sanitizer', 'consumed')
+
+    def __init__(self, iterator, wrapper, sanitizer):
+        self.iterator = iterator
+        self.wrapper = wrapper
+        self.sanitizer = sanitizer
+        self.consumed = False
+
+def _is_iterator(obj):
+    """
+    Returns `True` if *obj* is an iterator (e.g. a generator).
+    """
+    return hasattr(obj, '__next__') or hasattr(obj, 'next')
+
+def _iter_children(children):
+    """
+    Iterates over *children* (as returned by :meth:`TagWrap._children`),
+    consuming any deferred iterators one item at a time.
+    """
+    for child in children:
+        if isinstance(child, _Deferred):
+            child.consumed = True
+            wrapper, sanitizer = child.wrapper, child.sanitizer
+            for item in child.iterator:
+                for grandchild in _iter_children(
+                        wrapper._children((item,), sanitizer)):
+                    yield grandchild
+        else:
+            yield child
+
+def _chunked(texts, chunk_size, encoding=None):
+    """
+    Joins/splits the strings in *texts* into chunks of *chunk_size*
+    characters (the last one may be shorter).  If *encoding* is given the
+    chunks will be encoded using it.
+    """
+    buf = []
+    size = 0
+    for text in texts:
+        buf.append(text)
+        size += len(text)
+        if size < chunk_size:
+            continue
+        data = "".join(buf)
+        end = size - size % chunk_size
+        for i in range(0, end, chunk_size):
+            chunk = data[i:i+chunk_size]
+            yield chunk.encode(encoding) if encoding else chunk
+        buf = [data[end:]]
+        size -= end
+    if size:
+        data = "".join(buf)
+        yield data.encode(encoding) if encoding else data
+
+def strip_xss(html, whitelist=None, replacement="(removed)", cache=None):
     """
     This function returns a tuple containing:
 
@@ -216,157 +1345,1693 @@ def strip_xss(html, whitelist=None, replacement="(removed)"):
 
     .. note:: To disable the whitelisting simply set `whitelist="off"`.
 
+    .. note:: This is a thin wrapper around :class:`Sanitizer`; the policy
+        for each *whitelist*/*replacement* combination is only built once.
+
+    If a *cache* (a :class:`SanitizeCache`) is given the result will be
+    looked up there first (see :class:`SanitizeCache`).
+
     Example::
 
-        >>> html = '<span>Hello, exploit: <img src="javascript:alert(\"pwned!\")"></span>'
-        >>> html, rejects = strip_xss(html)
-        >>> print("'%s', Rejected: '%s'" % (html, " ".join(rejects)))
-        '<span>Hello, exploit: (removed)</span>', Rejected: '<img src="javascript:alert("pwned!")">'
+        >>> html = '<span>Hello, exploit: <img src="javascript:alert(\"pwned!\")"></span>'
+        >>> html, rejects = strip_xss(html)
+        >>> print("'%s', Rejected: '%s'" % (html, " ".join(rejects)))
+        '<span>Hello, exploit: (removed)</span>', Rejected: '<img src="javascript:alert("pwned!")">'
+
+    .. note:: The default *replacement* is "(removed)".
+
+    If *replacement* is "entities" bad HTML tags will be encoded into HTML
+    entities.  This allows things like <script>'whatever'</script> to be
+    displayed without execution (which would be much less annoying to users that
+    were merely trying to share a code example).  Here's an example::
+
+        >>> html = '<span>Hello, exploit: <img src="javascript:alert(\"pwned!\")"></span>'
+        >>> html, rejects = strip_xss(html, replacement="entities")
+        >>> print(html)
+        <span>Hello, exploit: &lt;img src="javascript:alert("pwned!")"&gt;</span>
+        >>> print("Rejected: '%s'" % ", ".join(rejects))
+        Rejected: '<img src="javascript:alert("pwned!")">'
+
+    UTF-8 encoded `bytes` can be sanitized directly (no need to decode them
+    first) in which case you get `bytes` back::
+
+        >>> html, rejects = strip_xss('<p>Café <script>alert(1)</script></p>'.encode('utf-8'))
+        >>> print(html.decode('utf-8'))
+        <p>Café (removed)alert(1)(removed)</p>
+        >>> sorted(rejects)
+        ['</script>', '<script>']
+
+    **NOTE:** This function should work to protect against *all* `the XSS
+    examples at OWASP
+    <https://www.owasp.org/index.php/XSS_Filter_Evasion_Cheat_Sheet>`_.  Please
+    `let us know <https://github.com/LiftoffSoftware/htmltag/issues>`_ if you
+    find something we missed.
+    """
+    return Sanitizer.get(whitelist, replacement).sanitize(html, cache)
+
+def strip_xss_many(htmls, whitelist=None, replacement="(removed)",
+                   processes=None, chunksize=64):
+    """
+    .. versionadded:: 1.8.0
+
+    Runs :func:`strip_xss` over all the given *htmls* using a pool of
+    *processes* (defaults to the number of CPUs), yielding the results in
+    order.  Handy for (re)sanitizing large amounts of stored user content
+    since all cores get used::
+
+        >>> from htmltag import strip_xss_many
+        >>> comments = ['<em>Nice!</em>', '<script>alert("pwned!")</script>']
+        >>> for html, rejects in strip_xss_many(comments, processes=2):
+        ...     print("%s %s" % (html, sorted(rejects)))
+        <em>Nice!</em> []
+        (removed)alert("pwned!")(removed) ['</script>', '<script>']
+
+    See :meth:`Sanitizer.map` for details.
+    """
+    sanitizer = Sanitizer.get(whitelist, replacement)
+    return sanitizer.map(htmls, processes=processes, chunksize=chunksize)
+
+if sys.version_info >= (3, 6): # async def is a SyntaxError before that
+    from _htmltag_async import aiter_chunks as _aiter_chunks
+    from _htmltag_async import write_to as _write_to
+else:
+    _aiter_chunks = _write_to = None
+
+class _Rendering(object):
+    """
+    Adds the streaming (and asyncio-friendly) rendering methods to
+    :class:`HTML` and :class:`Element`.  They're all built on `render_iter()`.
+    The asyncio ones (`aiter_chunks()` and `write_to()`) are only available
+    in Python 3.6+ (see the `_htmltag_async` module).
+    """
+    __slots__ = ()
+
+    def render_into(self, sink, encoding='utf-8', chunk_size=65536):
+        """
+        .. versionadded:: 1.8.0
+
+        Renders `self` straight into *sink* (a `bytearray` or anything with
+        a `write()` method that takes `bytes` like a file opened in binary
+        mode or `io.BytesIO`) as *encoding* and returns the number of bytes
+        written.  The output gets encoded a chunk (of *chunk_size*
+        characters) at a time so the whole document never has to exist as
+        one big string (or one big `bytes` object)::
+
+            >>> from htmltag import TagWrap
+            >>> buf = bytearray(b'<!DOCTYPE html>')
+            >>> p = TagWrap('p')
+            >>> p('Café').render_into(buf)
+            12
+            >>> print(buf.decode('utf-8'))
+            <!DOCTYPE html><p>Café</p>
+        """
+        write = sink.extend if isinstance(sink, bytearray) else sink.write
+        written = 0
+        for chunk in self.render_iter(chunk_size, encoding):
+            write(chunk)
+            written += len(chunk)
+        return written
+
+    if _aiter_chunks is not None: # Python 3.6+
+        aiter_chunks = _aiter_chunks
+        write_to = _write_to
+
+class HTML(stringtype, _Rendering):
+    """
+    .. versionadded:: 1.2.0
+
+    A subclass of Python's built-in `str` to add a simple `__html__` method
+    that lets us know this string is HTML and does not need to be escaped.  It
+    also has an `escaped` property that will return `self` with all special
+    characters converted into HTML entities.
+
+    Instances returned by :class:`TagWrap` also have a `tagname` attribute and,
+    if they were created in safe mode, a `sanitized_by` attribute pointing to
+    the :class:`Sanitizer` that was used (so they won't get scanned again when
+    wrapped by another tag that uses the same one).
+
+    To keep memory use down (there could be lots of these) `HTML` instances
+    don't have a `__dict__`; they take up no more room than a regular string.
+    Instead `tagname` and `sanitized_by` are stored in a subclass that gets
+    created (just once) for each combination of them.  The subclasses made
+    for a `Sanitizer` belong to it (and only refer back to it weakly) so they
+    don't keep it alive; `sanitized_by` becomes `None` once it's gone::
+
+        >>> from htmltag import b, HTML
+        >>> bold = b('bold')
+        >>> bold.tagname
+        'b'
+        >>> type(bold) is type(b('also bold'))
+        True
+        >>> isinstance(bold, HTML) and isinstance(bold, str)
+        True
+    """
+    __slots__ = ()
+    # These get overridden by the subclasses made by _variant():
+    _tagname = None
+    _sanitized_ref = None # A weakref to sanitized_by
+
+    @classmethod
+    def _variant(cls, tagname, sanitized_by):
+        """
+        Returns the subclass of *cls* that has the given *tagname* and
+        *sanitized_by* (or the class itself if they're both `None`).
+        """
+        base = cls.__dict__.get('_variant_of', cls)
+        if tagname is None and sanitized_by is None:
+            return base
+        if sanitized_by is None:
+            variants, ref = _html_variants, None
+        else:
+            variants = sanitized_by.__dict__.setdefault('_html_variants', {})
+            ref = weakref.ref(sanitized_by)
+        key = (base, tagname)
+        variant = variants.get(key)
+        if variant is None:
+            if type(tagname) is stringtype:
+                tagname = _intern(tagname)
+            variant = type(base.__name__, (base,), {
+                '__slots__': (),
+                '__module__': base.__module__,
+                '__doc__': base.__doc__,
+                '_variant_of': base,
+                '_tagname': tagname,
+                '_sanitized_ref': ref,
+            })
+            variant = variants.setdefault(key, variant)
+        return variant
+
+    @classmethod
+    def _make(cls, html, tagname=None, sanitized_by=None):
+        """
+        Returns a new instance of `HTML` with the given *tagname* and
+        *sanitized_by* attributes.
+        """
+        if sanitized_by is None:
+            variant = _html_variants.get((cls, tagname))
+        else:
+            variants = getattr(sanitized_by, '_html_variants', None)
+            variant = variants.get((cls, tagname)) if variants else None
+        if variant is None:
+            variant = cls._variant(tagname or None, sanitized_by or None)
+        return variant(html)
+
+    @property
+    def tagname(self):
+        """
+        The name of the tag this HTML was made with (if any).  Used by
+        :meth:`~HTML.append`.
+        """
+        return self._tagname
+
+    @tagname.setter
+    def tagname(self, tagname):
+        self.__class__ = self._variant(tagname or None, self.sanitized_by)
+
+    @property
+    def sanitized_by(self):
+        """
+        The :class:`Sanitizer` that was used to make this HTML (if any).
+        """
+        ref = self._sanitized_ref
+        return ref() if ref is not None else None
+
+    @sanitized_by.setter
+    def sanitized_by(self, sanitized_by):
+        self.__class__ = self._variant(self._tagname, sanitized_by or None)
+
+    def __reduce__(self):
+        # Our class might be one of the variants (which can't be pickled)
+        base = self.__class__.__dict__.get('_variant_of', self.__class__)
+        return (base._make,
+            (stringtype(self), self._tagname, self.sanitized_by))
+
+    def __html__(self):
+        """
+        Returns `self` (we're already a string) in unmodified form.
+        """
+        return self
+
+    @property
+    def escaped(self):
+        """
+        A property that returns `self` with all characters that have special
+        meaning (in HTML/XML) replaced with HTML entities.  Example::
+
+            >>> print(HTML('<span>These span tags will be escaped</span>').escaped)
+            &lt;span&gt;These span tags will be escaped&lt;/span&gt;
+
+        The most recently used results are cached (unless they're huge) so
+        asking for the same thing repeatedly is cheap.
+        """
+        escaped = _escaped_cache.get(self)
+        if escaped is None:
+            escaped = _xmlcharrefs(escape(self))
+            _escaped_cache.set(self, escaped)
+        return escaped
+
+    def render_iter(self, chunk_size=65536, encoding=None):
+        """
+        .. versionadded:: 1.8.0
+
+        Yields `self` in chunks of (at most) *chunk_size* characters.  If
+        *encoding* is given the chunks will be encoded (e.g. for use as a WSGI
+        response iterable).  See :meth:`Element.render_iter`.
+        """
+        return _chunked((self,), chunk_size, encoding)
+
+    def append(self, *strings):
+        """
+        Adds any number of supplied *strings* to `self` (we're a subclass of
+        `str` remember) just before the last closing tag and returns a new
+        instance of `~htmltag.HTML` with the result.
+        Example::
+
+            >>> from htmltag import span, b
+            >>> html = span('Test:')
+            >>> print(html)
+            <span>Test:</span>
+            >>> html = html.append(' ', b('appended'))
+            >>> print(html)
+            <span>Test: <b>appended</b></span>
+
+        In the case of self-closing tags like '<img>' the string will simply be
+        appended after the tag::
+
+            >>> from htmltag import img
+            >>> image = img(src="http://company.com/image.png")
+            >>> print(image.append("Appended string"))
+            <img src="http://company.com/image.png">Appended string
+
+        .. note:: Why not update ourselves in-place?  Because we're a subclass
+            of `str`; in Python strings are immutable.
+        """
+        strings = [ # Elements need to be rendered first
+            s.render() if isinstance(s, Element) else s for s in strings]
+        close_tag_start = self.rfind('</')
+        if self.tagname: # More accurate
+            close_tag_start = self.rfind('</'+self.tagname)
+        if close_tag_start == -1: # Couldn't find closing tag
+            return self + "".join(strings) # Just tack on to the end
+        ending = self[close_tag_start:]
+        beginning = self[:close_tag_start]
+        # Preserve the tagname (if any):
+        return HTML._make(
+            beginning + "".join(strings) + ending, self.tagname)
+
+class HTMLBuilder(object):
+    """
+    .. versionadded:: 1.8.0
+
+    A mutable version of :class:`HTML` for adding lots of things to an
+    element one at a time.  Calling :meth:`HTML.append` over and over again
+    gets slow since it copies the whole string every time; `HTMLBuilder` just
+    keeps track of what was appended and puts it all together (with a single
+    join) when :meth:`~HTMLBuilder.build` is called.  The result is exactly
+    what the equivalent :meth:`HTML.append` calls would have made.
+
+    Usually you'll get one from :meth:`TagWrap.builder`::
+
+        >>> from htmltag import TagWrap
+        >>> ul, li = TagWrap('ul'), TagWrap('li')
+        >>> builder = ul.builder(_class="list")
+        >>> for i in range(3):
+        ...     builder = builder.append(li(str(i)))
+        >>> print(builder.build())
+        <ul class="list"><li>0</li><li>1</li><li>2</li></ul>
+
+    Use :meth:`~HTMLBuilder.open` to append things to elements that are
+    themselves inside the one being built::
+
+        >>> builder = ul.builder()
+        >>> sublist = builder.append(li('one')).open(ul)
+        >>> sublist = sublist.append(li('one.one'), li('one.two'))
+        >>> print(builder.append(li('two')).build())
+        <ul><li>one</li><ul><li>one.one</li><li>one.two</li></ul><li>two</li></ul>
+
+    .. note:: Like with :meth:`HTML.append` strings are appended as-is (they
+        won't be escaped or sanitized).
+    """
+    __slots__ = ('tagname', '_beginning', '_pieces', '_ending')
+
+    def __init__(self, html):
+        if isinstance(html, Element):
+            html = html.render()
+        self.tagname = getattr(html, 'tagname', None)
+        # Figure out where things go the same way HTML.append() does:
+        close_tag_start = html.rfind('</')
+        if self.tagname: # More accurate
+            close_tag_start = html.rfind('</' + self.tagname)
+        if close_tag_start == -1: # Goes on the end
+            close_tag_start = len(html)
+        self._beginning = html[:close_tag_start]
+        self._ending = html[close_tag_start:]
+        self._pieces = [] # Strings and HTMLBuilders
+
+    def append(self, *strings):
+        """
+        Adds any number of supplied *strings* just before the last closing
+        tag (see :meth:`HTML.append`).  Returns `self`.
+        """
+        self._pieces.extend(
+            s.render() if isinstance(s, Element) else s for s in strings)
+        return self
+
+    def open(self, tag, *args, **attrs):
+        """
+        Appends a new *tag* (a :class:`TagWrap`) made with the given *args*
+        and *attrs* and returns an `HTMLBuilder` for it.  Whatever gets
+        appended to that builder will show up inside the new tag.
+        """
+        builder = tag.builder(*args, **attrs)
+        self._pieces.append(builder)
+        return builder
+
+    def _flatten(self, out):
+        """
+        Adds our beginning, pieces, and ending to the *out* list.
+        """
+        out.append(self._beginning)
+        for piece in self._pieces:
+            if isinstance(piece, HTMLBuilder):
+                piece._flatten(out)
+            else:
+                out.append(piece)
+        out.append(self._ending)
+
+    def build(self):
+        """
+        Returns everything as an :class:`HTML` string (with the same
+        `tagname` as the HTML we started with).  Appending can continue
+        afterwards.
+        """
+        out = []
+        self._flatten(out)
+        return HTML._make("".join(out), self.tagname)
+
+    __html__ = build
+
+    def __str__(self):
+        return self.build()
+
+class Element(_Rendering):
+    """
+    .. versionadded:: 1.8.0
+
+    What a :class:`TagWrap` returns when `lazy` is enabled:  A lightweight node
+    in a tree of elements.  Nothing gets copied around when elements are nested
+    inside each other; the whole tree is turned into a string with a single
+    join when it's needed (via `str()`, :meth:`~Element.render`, or
+    `__html__`).  Example::
+
+        >>> from htmltag import TagWrap
+        >>> ul = TagWrap('ul', lazy=True)
+        >>> li = ul.copy('li')
+        >>> html = ul(li('one'), li('two & three'), _class="list")
+        >>> html.tagname
+        'ul'
+        >>> print(html)
+        <ul class="list"><li>one</li><li>two &amp; three</li></ul>
+
+    Elements work like :class:`HTML` strings so you can still use the `append`
+    and `escaped` APIs on them (they'll be rendered first)::
+
+        >>> print(html.append(li('four')))
+        <ul class="list"><li>one</li><li>two &amp; three</li><li>four</li></ul>
+        >>> print(li('<b>').escaped)
+        &lt;li&gt;&amp;lt;b&amp;gt;&lt;/li&gt;
+
+    If safe mode is enabled the tree gets sanitized when it is rendered; just
+    like with :class:`HTML` only the parts that weren't already sanitized by
+    the same :class:`Sanitizer` get scanned.
+
+    The attributes an element was made with are kept (as a `dict`) in its
+    `attrs` and its `key` (the *key* keyword argument, which isn't rendered)
+    identifies it among its siblings when comparing two trees with
+    :func:`diff`.
+    """
+    __slots__ = (
+        'tagname', 'sanitizer', 'children', 'attrs', 'key', '_opening',
+        '_closing', '_wrapper', '_html')
+
+    def __init__(self, tagname, opening, children, closing,
+                 sanitizer=None, wrapper=None, attrs=None, key=None):
+        self.tagname = tagname
+        self.sanitizer = sanitizer
+        self.children = children
+        self.attrs = attrs or {}
+        self.key = key
+        self._opening = opening
+        self._closing = closing
+        self._wrapper = wrapper
+        self._html = None
+
+    def _texts(self, sanitizer):
+        """
+        Returns a tuple containing a list of strings that make up this
+        element and whether or not they can be considered sanitized by
+        *sanitizer*.
+        """
+        html = self._html
+        if html is not None: # Already rendered
+            return ([html], not sanitizer or html.sanitized_by is sanitizer)
+        own = self.sanitizer
+        scanner = _scan_pieces(
+            own, self._opening, self.children, self._closing)
+        if self._wrapper:
+            self._wrapper._log_rejects(scanner.rejected, self.tagname)
+        trusted = not sanitizer or (scanner.trusted and own is sanitizer)
+        return (scanner.out, trusted)
+
+    def _stream(self, sanitizer):
+        """
+        Like :meth:`~Element._texts` but yields ``(text, trusted)`` tuples as
+        soon as they're ready instead of building a list.
+        """
+        html = self._html
+        if html is not None: # Already rendered
+            yield (html, not sanitizer or html.sanitized_by is sanitizer)
+            return
+        own = self.sanitizer
+        same = not sanitizer or own is sanitizer
+        scanner = _PieceScanner(own, [])
+        out = scanner.out
+        scanner.feed(*self._opening)
+        for child in _iter_children(self.children):
+            if isinstance(child, Element):
+                for text, trusted in child._stream(own):
+                    scanner.feed(text, trusted)
+                    for text in out:
+                        yield (text, same)
+                    del out[:]
+                continue
+            scanner.feed(*child)
+            for text in out:
+                yield (text, same)
+            del out[:]
+        if self._closing[0]:
+            scanner.feed(*self._closing)
+        scanner.close()
+        if self._wrapper:
+            self._wrapper._log_rejects(scanner.rejected, self.tagname)
+        if out and not scanner.trusted: # Last bit is still dangling
+            for text in out[:-1]:
+                yield (text, same)
+            yield (out[-1], not sanitizer)
+        else:
+            for text in out:
+                yield (text, same)
+
+    def render_iter(self, chunk_size=65536, encoding=None):
+        """
+        Yields the rendered element in chunks of (at most) *chunk_size*
+        characters, in document order, without ever building the whole
+        string.  If *encoding* is given the chunks will be encoded (so they
+        can be written to a file or used as a WSGI response iterable)::
+
+            >>> from htmltag import TagWrap
+            >>> table = TagWrap('table', lazy=True)
+            >>> tr, td = table.copy('tr'), table.copy('td')
+            >>> rows = (tr(td(str(i))) for i in range(3))
+            >>> for chunk in table(rows).render_iter(chunk_size=20):
+            ...     print(chunk)
+            <table><tr><td>0</td
+            ></tr><tr><td>1</td>
+            </tr><tr><td>2</td><
+            /tr></table>
+
+        As the above demonstrates, iterators (e.g. generators) passed to lazy
+        tags won't be consumed until the element is rendered; that way only
+        one row at a time needs to exist in memory.  It also means such
+        elements can only be rendered once.
+
+        .. note:: Sanitization happens as the tree is walked, before the
+            output is split into chunks, so tags that end up crossing a chunk
+            boundary are handled just the same as everything else.
+        """
+        if self._html is not None:
+            return self._html.render_iter(chunk_size, encoding)
+        texts = (text for text, trusted in self._stream(None))
+        return _chunked(texts, chunk_size, encoding)
+
+    def render(self):
+        """
+        Returns the whole tree as an :class:`HTML` string.  The result is
+        cached so rendering the same element again is free.
+        """
+        if self._html is None:
+            sanitizer = self.sanitizer
+            texts, trusted = self._texts(sanitizer)
+            self._html = HTML._make("".join(texts), self.tagname,
+                sanitizer if trusted else None)
+        return self._html
+
+    __html__ = render
+
+    def __str__(self):
+        return self.render()
+
+    def __repr__(self):
+        return repr(self.render())
+
+    def __eq__(self, other):
+        if isinstance(other, Element):
+            other = other.render()
+        return self.render() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.render())
+
+    def __len__(self):
+        return len(self.render())
+
+    def __add__(self, other):
+        return self.render() + other
+
+    def __radd__(self, other):
+        return other + self.render()
+
+    def __getattr__(self, name):
+        # Everything else (escaped, append, startswith, etc) comes from HTML
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.render(), name)
+
+class Patch(object):
+    """
+    .. versionadded:: 1.8.0
+
+    One of the changes returned by :func:`diff`.  Every patch has an `op`
+    and a `path` (a tuple of child element indexes leading from the root
+    to the element it applies to; ``()`` is the root itself).  What else it
+    has depends on the `op`:
+
+        * ``'replace'``: Replace the element with `value` (:class:`HTML`).
+        * ``'set_attr'``: Set its `name` attribute to `value`.
+        * ``'remove_attr'``: Remove its `name` attribute.
+        * ``'insert'``: Insert `value` (:class:`HTML`) as child number
+          `index`.
+        * ``'remove'``: Remove child number `index`.
+        * ``'move'``: Take child number `source` out and put it back as
+          child number `index`.
+
+    Patches have to be applied in order; each one's indexes take the ones
+    before it into account.  Attribute values are given as they'd appear in
+    the DOM (i.e. with any HTML entities decoded).  Use
+    :meth:`~Patch.as_dict` to turn a patch into something that can be sent
+    as JSON.
+    """
+    __slots__ = ('op', 'path', 'index', 'source', 'name', 'value')
+    _fields = ('index', 'source', 'name', 'value')
+
+    def __init__(self, op, path, index=None, source=None, name=None,
+                 value=None):
+        self.op = op
+        self.path = path
+        self.index = index
+        self.source = source
+        self.name = name
+        self.value = value
+
+    def as_dict(self):
+        """
+        Returns this patch as a `dict` (leaving out the fields that don't
+        apply to its `op`) with the `path` as a list and the `value` as a
+        plain string.
+        """
+        patch = {'op': self.op, 'path': list(self.path)}
+        for field in self._fields:
+            value = getattr(self, field)
+            if value is not None:
+                patch[field] = stringtype(value) if field == 'value' else value
+        return patch
+
+    def __eq__(self, other):
+        if not isinstance(other, Patch):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ''.join(', %s=%r' % (field, getattr(self, field))
+            for field in self._fields if getattr(self, field) is not None)
+        return 'Patch(%r, %r%s)' % (self.op, self.path, fields)
+
+def diff(old, new):
+    """
+    .. versionadded:: 1.8.0
+
+    Returns a list of :class:`Patch` objects that will turn the DOM made from
+    *old* into the one that *new* would make.  Both should be :class:`Element`
+    trees (made by `lazy` tags); whatever changed gets re-rendered and
+    nothing else, so pushing the patches to a browser (e.g. over a websocket)
+    is much cheaper than sending the whole thing again::
+
+        >>> from htmltag import TagWrap, diff
+        >>> ul = TagWrap('ul', lazy=True)
+        >>> li = ul.copy('li')
+        >>> old = ul(li('One', key=1), li('Two', key=2), _class="list")
+        >>> new = ul(li('Two', key=2), li('Three', key=3), _class="list big")
+        >>> for patch in diff(old, new):
+        ...     print(patch)
+        Patch('set_attr', (), name='class', value='list big')
+        Patch('remove', (), index=0)
+        Patch('insert', (), index=1, value='<li>Three</li>')
+
+    Lazy tags take a *key* keyword argument (which doesn't get rendered)
+    that identifies a child among its siblings.  Keyed children are matched
+    up by key no matter where they've moved to (only the ones that have to
+    move get moved); children without one are matched up by position.
+
+    Elements whose tag name, key, or :class:`Sanitizer` changed get replaced
+    entirely, as do those whose content (other than child elements) changed.
+    To keep the patches correct anything that can't be patched precisely
+    (e.g. a tag the sanitizer would remove, text mixed in with the child
+    elements that changed, or an iterator that's already been used up) gets
+    replaced too.
+
+    .. note:: Paths only match the DOM if the HTML is valid as-is; browsers
+        rearrange things like a '<div>' inside a '<p>'.  Put table rows
+        inside a '<tbody>' (browsers add one if it's missing).
+    """
+    if not _exact(old) or not _exact(new):
+        patches = []
+        if _rendered(old) != _rendered(new):
+            patches.append(Patch('replace', (), value=_rendered(new)))
+        return patches
+    patches = []
+    _diff(old, new, (), patches)
+    return patches
+
+def _patchable(element):
+    """
+    Returns `True` if *element* is an :class:`Element` that will be rendered
+    as exactly one DOM element (so that it can be patched).
+    """
+    if not isinstance(element, Element):
+        return False
+    opening = element._opening
+    return opening[1] or _prescan(element.sanitizer, opening[0])[1]
+
+def _exact(element):
+    """
+    Returns `True` if *element* (and everything in it) will be rendered
+    exactly as-is; nothing will get removed by the sanitizer.  Otherwise
+    what's left over (e.g. the end tag of a removed tag) could close other
+    elements and the DOM won't match the tree anymore.
+    """
+    children = _children_of(element)
+    if children is None or not _patchable(element):
+        return False
+    sanitizer = element.sanitizer
+    for child in children:
+        if isinstance(child, Element):
+            if not _exact(child):
+                return False
+        elif not child[1] and not _prescan(sanitizer, child[0])[1]:
+            return False
+    return True
+
+def _diff(old, new, path, patches):
+    """
+    Adds the patches needed to turn *old* into *new* (both exact
+    :class:`Element` instances at *path*) to *patches*.
+    """
+    if old is new:
+        return
+    if (old.tagname != new.tagname or old.key != new.key
+            or old.sanitizer is not new.sanitizer):
+        patches.append(Patch('replace', path, value=new.render()))
+        return
+    attr_patches = _diff_attrs(old, new, path)
+    if attr_patches is not None:
+        old_children, new_children = _elements(old), _elements(new)
+        if old_children is not None and new_children is not None:
+            patches.extend(attr_patches)
+            _diff_children(old_children, new_children, path, patches)
+            return
+        if _same_children(old.children, new.children):
+            patches.extend(attr_patches)
+            return
+    patches.append(Patch('replace', path, value=new.render()))
+
+def _diff_attrs(old, new, path):
+    """
+    Returns a list of the patches needed to change the attributes of *old*
+    into those of *new* at *path* or `None` if they can't be patched.
+    """
+    if old.attrs == new.attrs:
+        return []
+    old_attrs, new_attrs = _dom_attrs(old), _dom_attrs(new)
+    if old_attrs is None or new_attrs is None:
+        return None
+    patches = []
+    for name in sorted(set(old_attrs) - set(new_attrs)):
+        patches.append(Patch('remove_attr', path, name=name))
+    for name, value in sorted(new_attrs.items()):
+        if old_attrs.get(name) != value:
+            patches.append(Patch('set_attr', path, name=name, value=value))
+    return patches
+
+def _dom_attrs(element):
+    """
+    Returns a `dict` of the attributes of *element* as they'd appear in the
+    DOM or `None` if that can't be worked out reliably.
+    """
+    attrs = {}
+    for name, value in element.attrs.items():
+        if value == False: # Same as rendering
+            continue
+        name = name.lstrip('_')
+        if value == True:
+            value = ''
+        else:
+            value = '{0}'.format(value)
+            if _unsafe_value_re.search(value):
+                return None
+            value = _unescape(value)
+        if name in attrs:
+            return None
+        attrs[name] = value
+    return attrs
+
+def _children_of(element):
+    """
+    Returns the children of *element* with any iterators that haven't been
+    consumed yet expanded (and kept that way) or `None` if some have already
+    been used up.
+    """
+    children = element.children
+    for child in children:
+        if isinstance(child, _Deferred):
+            break
+    else:
+        return children
+    if any(child.consumed for child in children
+            if isinstance(child, _Deferred)):
+        return None
+    children = element.children = list(_iter_children(children))
+    return children
+
+def _elements(element):
+    """
+    Returns the children of *element* if they're all :class:`Element`
+    instances or `None` if they aren't.
+    """
+    children = element.children # Already expanded by _exact()
+    if all(isinstance(child, Element) for child in children):
+        return children
+    return None
+
+def _same_children(old, new):
+    """
+    Returns `True` if the *old* and *new* children (as returned by
+    :meth:`TagWrap._children`) will be rendered the same way.
+    """
+    if len(old) != len(new):
+        return False
+    for old_child, new_child in zip(old, new):
+        old_element = isinstance(old_child, Element)
+        if old_element != isinstance(new_child, Element):
+            return False
+        if old_element:
+            if old_child.render() != new_child.render():
+                return False
+        elif old_child != new_child:
+            return False
+    return True
+
+# Children without a key get (_unkeyed, <their position amongst them>):
+_unkeyed = object()
+
+def _child_keys(children):
+    """
+    Returns a list of the keys of the given *children* (see :func:`diff`).
+    """
+    keys, position = [], 0
+    for child in children:
+        if child.key is None:
+            keys.append((_unkeyed, position))
+            position += 1
+        else:
+            keys.append(child.key)
+    if len(set(keys)) != len(keys): # Duplicate keys; match by position
+        return [(_unkeyed, i) for i in range(len(keys))]
+    return keys
+
+def _diff_children(old, new, path, patches):
+    """
+    Adds the patches needed to turn the *old* children (a list of
+    :class:`Element` instances) of the element at *path* into the *new*
+    ones to *patches*.
+    """
+    old_keys, new_keys = _child_keys(old), _child_keys(new)
+    if old_keys == new_keys: # Nothing was added, removed, or moved
+        for i, child in enumerate(new):
+            _diff(old[i], child, path + (i,), patches)
+        return
+    wanted = dict((key, i) for i, key in enumerate(new_keys))
+    for i in reversed(range(len(old_keys))):
+        if old_keys[i] not in wanted:
+            patches.append(Patch('remove', path, index=i))
+    current = [key for key in old_keys if key in wanted]
+    # Leave the longest run of children that are already in the right order
+    # where they are and move the others around them:
+    stable = set(_longest_run(current, wanted))
+    matched = set(current)
+    anchor = None # Everything gets placed in front of the next child
+    for i in reversed(range(len(new_keys))):
+        key = new_keys[i]
+        if key not in stable:
+            if key in matched:
+                source = current.index(key)
+                del current[source]
+            index = current.index(anchor) if anchor is not None else len(
+                current)
+            current.insert(index, key)
+            if key not in matched:
+                patches.append(Patch(
+                    'insert', path, index=index, value=new[i].render()))
+            elif index != source:
+                patches.append(Patch(
+                    'move', path, index=index, source=source))
+        anchor = key
+    old_children = dict(zip(old_keys, old))
+    for i, key in enumerate(new_keys):
+        if key in matched:
+            _diff(old_children[key], new[i], path + (i,), patches)
+
+def _longest_run(keys, wanted):
+    """
+    Returns the longest list of *keys* (in order) whose positions in
+    *wanted* (a dict of key: position) are increasing.
+    """
+    tails = [] # Positions that end the best run of each length
+    ends = [] # Index (in keys) of the key that ends the best run
+    previous = [None] * len(keys)
+    for i, key in enumerate(keys):
+        position = wanted[key]
+        length = bisect.bisect_left(tails, position)
+        if length == len(tails):
+            tails.append(position)
+            ends.append(i)
+        else:
+            tails[length] = position
+            ends[length] = i
+        if length:
+            previous[i] = ends[length - 1]
+    run = []
+    i = ends[-1] if ends else None
+    while i is not None:
+        run.append(keys[i])
+        i = previous[i]
+    run.reverse()
+    return run
+
+class AttrCache(object):
+    """
+    .. versionadded:: 1.8.0
+
+    A size-bounded LRU cache of rendered opening/closing tags keyed by the
+    tag name and its attributes.  Useful when the same attributes keep getting
+    passed to the same tags (e.g. ``tr(..., _class="row odd")``) but can't be
+    bound ahead of time with :meth:`TagWrap.bind`.
+
+    Give it to specific tags via the *attr_cache* keyword argument or use
+    one for all tags by setting `TagWrap.attr_cache`::
+
+        >>> cache = AttrCache(maxsize=2)
+        >>> td = TagWrap('td', attr_cache=cache)
+        >>> for cls in ('odd', 'even', 'odd', 'total'):
+        ...     html = td('x', _class=cls)
+        >>> cache.hits, cache.misses, cache.evictions
+        (1, 3, 1)
+
+    Attributes with unhashable values (e.g. lists) simply bypass the cache.
+    It can be shared between threads.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __getstate__(self): # Locks can't be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored for *key* or `None` if there isn't one.
+        Raises `TypeError` if *key* isn't hashable.
+        """
+        with self._lock:
+            cache = self._cache
+            value = cache.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            cache[key] = value # Now it's the most recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Stores *value* under *key*, evicting the least recently used entry if
+        we're full.
+        """
+        with self._lock:
+            cache = self._cache
+            cache[key] = value
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Empties the cache and resets the statistics.
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        """
+        Does the work for :meth:`~AttrCache.clear` (with the lock held).
+        """
+        self._cache.clear()
+        self.hits = self.misses = self.evictions = 0
+
+class _Counters(object):
+    """
+    The numbers tracked by :class:`Metrics` (for all tags and for each one).
+    """
+    def __init__(self):
+        self.calls = 0
+        self.chars = 0
+        self.rejects = 0
+        self.time = {}
+
+    @property
+    def sanitize_time(self):
+        """
+        Total time (in seconds) spent sanitizing.
+        """
+        return self.time.get('sanitize', 0.0)
+
+    def as_dict(self):
+        """
+        Returns our counters as a `dict`.
+        """
+        return {
+            'calls': self.calls,
+            'chars': self.chars,
+            'rejects': self.rejects,
+            'time': dict(self.time),
+        }
+
+class SanitizeCache(AttrCache):
+    """
+    .. versionadded:: 1.8.0
+
+    A size-bounded LRU cache of :class:`Sanitizer` results keyed by the HTML
+    that was scanned and the policy (whitelist, replacement, etc) it was
+    scanned with.  HTML that's been seen before (clean or not) won't have to
+    be scanned again.  Besides *maxsize* (the maximum number of entries) it
+    is also limited to *maxchars*:  The total length (in characters, not
+    encoded bytes) of all the HTML it holds (both before and after
+    sanitizing).  Entries that are larger than that all on their own won't be
+    cached at all.
+
+    Use it for specific calls to :func:`strip_xss` or set `Sanitizer.cache`
+    to use it everywhere (including :class:`TagWrap`)::
+
+        >>> cache = SanitizeCache(maxsize=100, maxchars=1024 * 1024)
+        >>> bio = '<em>Hi!</em> <img src=x onerror="alert(1)">'
+        >>> for i in range(3):
+        ...     html, rejects = strip_xss(bio, cache=cache)
+        >>> print(html)
+        <em>Hi!</em> (removed)
+        >>> cache.hits, cache.misses, len(cache), cache.chars
+        (2, 1, 1, 65)
+    """
+    def __init__(self, maxsize=1024, maxchars=16 * 1024 * 1024):
+        AttrCache.__init__(self, maxsize)
+        self.maxchars = maxchars
+        self.chars = 0
+
+    @staticmethod
+    def _size(key, value):
+        """
+        Returns how much room the given cache entry takes up.
+        """
+        return len(key[-1]) + len(value[0]) + len(value[2])
+
+    def set(self, key, value):
+        """
+        Stores *value* under *key*, evicting the least recently used entries
+        until we're within `maxsize` and `maxchars` again.
+        """
+        size = self._size(key, value)
+        if size > self.maxchars:
+            return
+        with self._lock:
+            cache = self._cache
+            old = cache.pop(key, None)
+            if old is not None:
+                self.chars -= self._size(key, old)
+            cache[key] = value
+            self.chars += size
+            while len(cache) > self.maxsize or self.chars > self.maxchars:
+                key, value = cache.popitem(last=False)
+                self.chars -= self._size(key, value)
+                self.evictions += 1
+
+    def _clear(self):
+        AttrCache._clear(self)
+        self.chars = 0
+
+class _EscapedCache(SanitizeCache):
+    """
+    The cache used by :attr:`HTML.escaped` (keyed by the HTML itself).
+    """
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(value)
+
+# The most recently used HTML.escaped results (a few MB worth at most):
+_escaped_cache = _EscapedCache(maxsize=256, maxchars=4 * 1024 * 1024)
+# The most recently used shared Sanitizer instances (see Sanitizer.get()).
+# Policies can be made up on the fly so this has to be bounded too:
+_sanitizers = AttrCache(maxsize=256)
+
+# Every FragmentCache (so invalidate() can find them):
+_fragment_caches = weakref.WeakSet()
+_fragment_caches_lock = threading.Lock()
+
+class _Flight(object):
+    """
+    A value that one thread is busy computing for a :class:`FragmentCache`
+    (see :meth:`FragmentCache.fetch`).  Other threads that want the same
+    value wait for it instead of computing it again.
+    """
+    def __init__(self, groups):
+        self.groups = groups
+        self.thread = threading.current_thread()
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def result(self):
+        """
+        Waits for the value to be computed and returns it (or raises
+        whatever computing it raised).
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class FragmentCache(AttrCache):
+    """
+    .. versionadded:: 1.8.0
+
+    A size-bounded LRU cache of rendered :class:`HTML` fragments (see
+    :func:`cached`).  Entries can also expire (after a given number of
+    seconds) and belong to any number of *groups* that can be invalidated
+    all at once::
+
+        >>> cache = FragmentCache(maxsize=10)
+        >>> cache.set('menu', HTML('<nav>Home</nav>'), groups=['nav'])
+        >>> print(cache.get('menu'))
+        <nav>Home</nav>
+        >>> cache.invalidate(group='nav')
+        >>> print(cache.get('menu'))
+        None
+
+    Use :meth:`~FragmentCache.fetch` to look something up and compute it if
+    it isn't there; it makes sure that only one thread at a time computes
+    the value for a given key.
+    """
+    def __init__(self, maxsize=128):
+        AttrCache.__init__(self, maxsize)
+        self._groups = {} # Group: set() of keys
+        self._flights = {} # Key: _Flight
+        with _fragment_caches_lock:
+            _fragment_caches.add(self)
+
+    def __getstate__(self): # Neither can threads or events
+        state = AttrCache.__getstate__(self)
+        state['_flights'] = {}
+        return state
+
+    def __setstate__(self, state):
+        AttrCache.__setstate__(self, state)
+        with _fragment_caches_lock:
+            _fragment_caches.add(self)
+
+    def get(self, key):
+        """
+        Returns the value stored for *key* or `None` if there isn't one (or
+        it has expired).  Raises `TypeError` if *key* isn't hashable.
+        """
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        """
+        Does the work for :meth:`~FragmentCache.get` (with the lock held).
+        """
+        cache = self._cache
+        entry = cache.pop(key, None)
+        if entry is not None:
+            value, expires, groups = entry
+            if expires is None or _timer() < expires:
+                cache[key] = entry # Now it's the most recently used
+                self.hits += 1
+                return value
+            self._forget(key, groups)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None, groups=()):
+        """
+        Stores *value* under *key* for *ttl* seconds (forever if `None`) as
+        part of the given *groups*, evicting the least recently used entry
+        if we're full.
+        """
+        with self._lock:
+            self._set(key, value, ttl, groups)
+
+    def _set(self, key, value, ttl, groups):
+        """
+        Does the work for :meth:`~FragmentCache.set` (with the lock held).
+        """
+        cache = self._cache
+        old = cache.pop(key, None)
+        if old is not None:
+            self._forget(key, old[2])
+        expires = None if ttl is None else _timer() + ttl
+        groups = tuple(groups)
+        cache[key] = (value, expires, groups)
+        for group in groups:
+            self._groups.setdefault(group, set()).add(key)
+        if len(cache) > self.maxsize:
+            key, entry = cache.popitem(last=False)
+            self._forget(key, entry[2])
+            self.evictions += 1
+
+    def _forget(self, key, groups):
+        """
+        Removes *key* from the given *groups* (it's no longer cached).
+        """
+        for group in groups:
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
+
+    def fetch(self, key, compute, ttl=None, groups=()):
+        """
+        Returns the value stored for *key*.  If there isn't one *compute* will
+        be called (without arguments) to make it and the result will be
+        stored (see :meth:`~FragmentCache.set`) unless it's `None`.
+
+        If another thread is already computing the value for *key* we'll
+        wait for it and return (or raise) whatever it ends up with.  Values
+        that get invalidated while they're being computed are returned but
+        not stored.
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(tuple(groups))
+        if not leader:
+            if flight.thread is threading.current_thread():
+                return compute() # Don't wait for ourselves
+            return flight.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+            raise
+        flight.value = value
+        with self._lock:
+            if self._flights.get(key) is flight: # Not invalidated
+                del self._flights[key]
+                if value is not None:
+                    self._set(key, value, ttl, flight.groups)
+        flight.done.set()
+        return value
+
+    def invalidate(self, key=None, group=None):
+        """
+        Removes *key* and/or everything in *group* from the cache (including
+        values that are still being computed; see
+        :meth:`~FragmentCache.fetch`).
+        """
+        with self._lock:
+            keys = set()
+            if group is not None:
+                keys.update(self._groups.get(group, ()))
+            if key is not None:
+                keys.add(key)
+            for key in keys:
+                entry = self._cache.pop(key, None)
+                if entry is not None:
+                    self._forget(key, entry[2])
+                self._flights.pop(key, None)
+            if group is not None:
+                for key, flight in list(self._flights.items()):
+                    if group in flight.groups:
+                        del self._flights[key]
+
+    def _clear(self):
+        AttrCache._clear(self)
+        self._groups.clear()
+        self._flights.clear()
+
+def cached(key=None, ttl=None, maxsize=128, group=None, cache=None):
+    """
+    .. versionadded:: 1.8.0
+
+    Decorates a function that returns :class:`HTML` (e.g. a sidebar or a
+    menu that rarely changes) so the result gets cached.  Calling it again
+    (with the same arguments) returns the cached `HTML` as-is; it won't need
+    to be sanitized again when it's put inside other tags::
+
+        >>> from htmltag import cached, ul, li
+        >>> @cached(ttl=60, group='nav')
+        ... def menu(*items):
+        ...     print("Rendering...")
+        ...     return ul(*[li(item) for item in items])
+        >>> print(menu('Home', 'About'))
+        Rendering...
+        <ul><li>Home</li><li>About</li></ul>
+        >>> print(menu('Home', 'About'))
+        <ul><li>Home</li><li>About</li></ul>
+        >>> menu.invalidate('Home', 'About') # Or: invalidate('nav')
+        >>> print(menu('Home', 'About'))
+        Rendering...
+        <ul><li>Home</li><li>About</li></ul>
+
+    :param key: A function that will be called with the same arguments to
+        get the key for the result.  Defaults to the arguments themselves
+        (calls with unhashable arguments won't be cached).
+    :param ttl: The number of seconds the result may be cached for.
+        Defaults to `None` (until it gets evicted or invalidated).
+    :param maxsize: The maximum number of results to keep (the least
+        recently used ones get evicted first).
+    :param group: The name of a group (or a list of them) to add the results
+        to.  See :func:`invalidate`.
+    :param cache: The :class:`FragmentCache` to use (*maxsize* will be
+        ignored).  Handy for sharing one between a number of functions.
+
+    The decorated function will have a `cache` attribute (its
+    `FragmentCache`) and an `invalidate` method that removes the result
+    for the arguments it's given.  If a number of threads ask for the
+    same (uncached) result at once it only gets made once.  Results that
+    are lazy :class:`Element` trees get rendered before they're cached.
+
+    .. note:: Settings from :func:`policy` are taken into account: a
+        result made inside a ``with policy(...)`` block will only be used
+        inside another one with the same settings.
+    """
+    if cache is None:
+        cache = FragmentCache(maxsize)
+    if group is None:
+        groups = ()
+    elif isinstance(group, (list, tuple, set, frozenset)):
+        groups = tuple(group)
+    else:
+        groups = (group,)
+    def decorator(fn):
+        def key_for(args, kwargs):
+            if key is not None:
+                return (fn, key(*args, **kwargs))
+            return (fn, args, tuple(sorted(kwargs.items())))
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            compute = lambda: _rendered(fn(*args, **kwargs))
+            own_key = key_for(args, kwargs)
+            if not _is_hashable(own_key):
+                return compute()
+            overrides = _overrides.get()
+            return cache.fetch((own_key, overrides and overrides[0]),
+                compute, ttl, groups + (own_key,))
+        def invalidate(*args, **kwargs):
+            cache.invalidate(group=key_for(args, kwargs))
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
+def invalidate(group):
+    """
+    .. versionadded:: 1.8.0
+
+    Removes everything in *group* from every :class:`FragmentCache` (e.g.
+    all the results of functions decorated with ``@cached(group=group)``).
+    """
+    with _fragment_caches_lock:
+        caches = list(_fragment_caches)
+    for cache in caches:
+        cache.invalidate(group=group)
+
+def _rendered(html):
+    """
+    Returns *html* rendered into :class:`HTML` if it's an :class:`Element`.
+    Everything else is returned as-is.
+    """
+    if isinstance(html, Element):
+        return html.render()
+    return html
+
+def _is_hashable(obj):
+    """
+    Returns `True` if *obj* can be hashed.
+    """
+    try:
+        hash(obj)
+    except TypeError:
+        return False
+    return True
+
+class Metrics(_Counters):
+    """
+    .. versionadded:: 1.8.0
+
+    Collects statistics about what :class:`TagWrap` instances are doing:
+
+        * `calls`: The number of tags that were made.
+        * `chars`: How many characters of HTML they produced.
+        * `rejects`: How many unsafe tags were removed by the sanitizer.
+        * `time`: A `dict` of the time (in seconds) spent on each step
+          (``'wrap'`` and ``'sanitize'``).  `sanitize_time` is a shortcut.
+
+    Totals are kept as attributes of the `Metrics` instance itself; `tags` is
+    a `dict` with the same numbers for each tag name.  Give it to specific
+    tags via the *metrics* keyword argument or collect them for all tags by
+    setting `TagWrap.metrics`::
+
+        >>> metrics = Metrics()
+        >>> td = TagWrap('td', metrics=metrics)
+        >>> print(td(HTML('<b onclick="evil()">Hi</b>')))
+        <td>(removed)Hi</b></td>
+        >>> html = td('Hello')
+        >>> metrics.calls, metrics.chars, metrics.rejects
+        (2, 38, 1)
+        >>> sorted(metrics.tags['td'].as_dict())
+        ['calls', 'chars', 'rejects', 'time']
+
+    Callables added via :meth:`~Metrics.add_hook` get called with the name
+    of the step and the tag name before each step.  If they return something
+    it will be called with the elapsed time (in seconds) once the step is
+    complete.  That makes it easy to hook up your own profiler::
+
+        >>> def hook(step, tagname):
+        ...     print("Starting %s <%s>" % (step, tagname))
+        ...     def finished(elapsed):
+        ...         print("Finished %s <%s>" % (step, tagname))
+        ...     return finished
+        >>> metrics.add_hook(hook)
+        >>> html = td('<b>Hello</b>')
+        Starting wrap <td>
+        Starting sanitize <td>
+        Finished sanitize <td>
+        Finished wrap <td>
+
+    .. note:: Elements made by lazy tags (see :class:`Element`) get
+        sanitized when they're rendered; only their `calls` and ``'wrap'``
+        time get counted.
+
+    When metrics are disabled (the default) the only overhead is checking
+    whether `TagWrap.metrics` is `None`.
+    """
+    def __init__(self):
+        _Counters.__init__(self)
+        self.tags = {}
+        self.hooks = []
+        self._lock = threading.Lock() # For updating the counters
+
+    def add_hook(self, callback):
+        """
+        Calls *callback(step, tagname)* before every step from now on.  See
+        above.
+        """
+        self.hooks.append(callback)
+
+    def remove_hook(self, callback):
+        """
+        Stops calling *callback*.
+        """
+        self.hooks.remove(callback)
+
+    def _counters(self, tagname):
+        """
+        Returns the counters for *tagname* (creating them if necessary).
+        """
+        counters = self.tags.get(tagname)
+        if counters is None:
+            counters = self.tags[tagname] = _Counters()
+        return counters
+
+    def measure(self, step, tagname, func, *args):
+        r"""
+        Returns the result of *func(\*args)*, timing it as *step* of making
+        *tagname* (and calling any hooks).
+        """
+        finishers = []
+        for hook in self.hooks:
+            finish = hook(step, tagname)
+            if finish is not None:
+                finishers.append(finish)
+        start = _timer()
+        result = func(*args)
+        elapsed = _timer() - start
+        with self._lock:
+            for counters in (self, self._counters(tagname)):
+                counters.time[step] = counters.time.get(step, 0.0) + elapsed
+        for finish in reversed(finishers):
+            finish(elapsed)
+        return result
+
+    def record(self, tagname, chars=0, rejects=0):
+        """
+        Counts a call that made *tagname* (producing *chars* characters and
+        rejecting *rejects* tags).
+        """
+        with self._lock:
+            for counters in (self, self._counters(tagname)):
+                counters.calls += 1
+                counters.chars += chars
+                counters.rejects += rejects
+
+    def reset(self):
+        """
+        Sets all counters back to zero (hooks are kept).
+        """
+        with self._lock:
+            _Counters.__init__(self)
+            self.tags = {}
+
+class RejectSink(object):
+    """
+    .. versionadded:: 1.8.0
+
+    Where :class:`TagWrap` reports rejected (unsafe) HTML when `log_rejects`
+    is enabled.  Each time something gets rejected a record (a `dict`) like
+    this gets passed to *destination*::
+
+        {'kind': 'reject', 'source': 'TagWrap', 'tagname': 'p',
+         'rejected': set(['<script>'])}
 
-    .. note:: The default *replacement* is "(removed)".
+    The default *destination* is :meth:`RejectSink.log` which logs it using
+    :meth:`logging.error` (the same as older versions of htmltag did).
 
-    If *replacement* is "entities" bad HTML tags will be encoded into HTML
-    entities.  This allows things like <script>'whatever'</script> to be
-    displayed without execution (which would be much less annoying to users that
-    were merely trying to share a code example).  Here's an example::
+    When dealing with a flood of hostile input it's usually best to limit how
+    many records get produced.  If *sample* is given only one in every
+    *sample* rejects will be passed on.  If *rate_limit* is given no more than
+    that many will be passed on per *interval* (seconds).  Counts of each
+    rejected tag are kept regardless and a single ``'summary'`` record gets
+    sent when :meth:`~RejectSink.flush` is called (or automatically at the
+    end of an *interval* in which some records were held back)::
 
-        >>> html = '<span>Hello, exploit: <img src="javascript:alert(\"pwned!\")"></span>'
-        >>> html, rejects = strip_xss(html, replacement="entities")
-        >>> print(html)
-        <span>Hello, exploit: &lt;img src="javascript:alert("pwned!")"&gt;</span>
-        >>> print("Rejected: '%s'" % ", ".join(rejects))
-        Rejected: '<img src="javascript:alert("pwned!")">'
+        >>> records = []
+        >>> sink = RejectSink(records.append, rate_limit=1)
+        >>> p = TagWrap('p', log_rejects=True, reject_sink=sink)
+        >>> for i in range(3):
+        ...     html = p(HTML('<b onclick="evil()">Hi</b>'))
+        >>> html = p('Nothing to see here')
+        >>> len(records)
+        1
+        >>> sink.flush()
+        >>> summary = records[-1]
+        >>> summary['kind'], summary['counts'], summary['suppressed']
+        ('summary', {'<b onclick="evil()">': 3}, 2)
 
-    **NOTE:** This function should work to protect against *all* `the XSS
-    examples at OWASP
-    <https://www.owasp.org/index.php/XSS_Filter_Evasion_Cheat_Sheet>`_.  Please
-    `let us know <https://github.com/LiftoffSoftware/htmltag/issues>`_ if you
-    find something we missed.
+    To use a sink for all tags set `TagWrap.reject_sink`.  No more than
+    *max_tags* different tags will be counted between flushes (to keep
+    memory use in check); anything beyond that gets counted as ``'...'``.
     """
-    re_html_tag = re.compile( # This matches HTML tags (if used correctly)
-      "(?i)<\/?\w+((\s+\w+(\s*=\s*(?:\".*?\"|'.*?'|[^'\">\s]+))?)+\s*|\s*)\/?>")
-    # This will match things like 'onmouseover=' ('on<whatever>=')
-    on_events_re = re.compile('.*\s+(on[a-z]+\s*=).*')
-    if not whitelist:
-        # These are all pretty safe and covers most of what users would want in
-        # terms of formatting and sharing media (images, audio, video, etc).
-        whitelist = set([
-            'a', 'abbr', 'aside', 'audio', 'bdi', 'bdo', 'blockquote', 'canvas',
-            'caption', 'code', 'col', 'colgroup', 'data', 'dd', 'del',
-            'details', 'div', 'dl', 'dt', 'em', 'figcaption', 'figure', 'h1',
-            'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li',
-            'mark', 'ol', 'p', 'pre', 'q', 'rp', 'rt', 'ruby', 's', 'samp',
-            'small', 'source', 'span', 'strong', 'sub', 'summary', 'sup',
-            'table', 'td', 'th', 'time', 'tr', 'track', 'u', 'ul', 'var',
-            'video', 'wbr'
-        ])
-    elif whitelist == "off":
-        whitelist = None # Disable it altogether
-    bad_tags = set()
-    for tag in re_html_tag.finditer(html):
-        tag = tag.group()
-        tag_lower = tag.lower()
-        short_tag = tag_lower.split()[0].lstrip('</').rstrip('>')
-        if whitelist and short_tag not in whitelist:
-            bad_tags.add(tag)
-            continue
-        # Make sure the tag can't execute any JavaScript
-        if "javascript:" in tag_lower:
-            bad_tags.add(tag)
-            continue
-        # on<whatever> events are not allowed (just another XSS vuln)
-        if on_events_re.search(tag_lower):
-            bad_tags.add(tag)
-            continue
-        # Flash sucks
-        if "fscommand" in tag_lower:
-            bad_tags.add(tag)
-            continue
-        # I'd be impressed if an attacker tried this one (super obscure)
-        if "seeksegmenttime" in tag_lower:
-            bad_tags.add(tag)
-            continue
-        # Yes we'll protect IE users from themselves...
-        if "vbscript:" in tag_lower:
-            bad_tags.add(tag)
-            continue
-    if replacement == "entities":
-        for bad_tag in bad_tags:
-            escaped = cgi.escape(bad_tag).encode('ascii', 'xmlcharrefreplace')
-            html = html.replace(bad_tag, escaped.decode('ascii'))
-    else:
-        for bad_tag in bad_tags:
-            html = html.replace(bad_tag, replacement)
-    return (html, bad_tags)
+    def __init__(self, destination=None, sample=1, rate_limit=None,
+                 interval=60.0, max_tags=1000):
+        self.destination = destination or self.log
+        self.sample = sample
+        self.rate_limit = rate_limit
+        self.interval = interval
+        self.max_tags = max_tags
+        self._lock = threading.Lock()
+        self._reset(_timer())
 
-class HTML(stringtype):
-    """
-    .. versionadded:: 1.2.0
+    def _reset(self, now):
+        """
+        Starts a new interval at *now*.
+        """
+        self.counts = {}
+        self.events = 0
+        self.sent = 0
+        self._window_start = now
 
-    A subclass of Python's built-in `str` to add a simple `__html__` method
-    that lets us know this string is HTML and does not need to be escaped.  It
-    also has an `escaped` property that will return `self` with all special
-    characters converted into HTML entities.
-    """
-    tagname = None
-    def __html__(self):
+    @staticmethod
+    def log(record):
         """
-        Returns `self` (we're already a string) in unmodified form.
+        The default destination:  Logs *record* using :meth:`logging.error`.
         """
-        return self
+        if record['kind'] == 'summary':
+            logging.error(
+                "Rejected {events} unsafe HTML fragment(s) ({suppressed} not "
+                "logged individually): {counts}".format(**record))
+        else:
+            logging.error(
+                "{source} rejected unsafe HTML: '{rejected}'".format(
+                **record))
 
-    @property
-    def escaped(self):
+    def report(self, source, tagname, rejected):
         """
-        A property that returns `self` with all characters that have special
-        meaning (in HTML/XML) replaced with HTML entities.  Example::
+        Records that *source* (e.g. ``'TagWrap'``) *rejected* the given set
+        of tags while making *tagname*, passing a record on to the
+        destination unless sampling or rate limiting says otherwise.
+        """
+        summary = None
+        with self._lock:
+            now = _timer()
+            if now - self._window_start >= self.interval:
+                if self.sent < self.events: # Some were held back
+                    summary = self._summary()
+                self._reset(now)
+            counts = self.counts
+            for tag in rejected:
+                if tag not in counts and len(counts) >= self.max_tags:
+                    tag = '...'
+                counts[tag] = counts.get(tag, 0) + 1
+            self.events += 1
+            send = (self.events - 1) % self.sample == 0
+            if send and self.rate_limit is not None:
+                send = self.sent < self.rate_limit
+            if send:
+                self.sent += 1
+        if summary:
+            self.destination(summary)
+        if send:
+            self.destination({
+                'kind': 'reject',
+                'source': source,
+                'tagname': tagname,
+                'rejected': rejected,
+            })
 
-            >>> print(HTML('<span>These span tags will be escaped</span>').escaped)
-            &lt;span&gt;These span tags will be escaped&lt;/span&gt;
+    def _summary(self):
         """
-        return cgi.escape(self).encode(
-            'ascii', 'xmlcharrefreplace').decode('ascii')
+        Returns a summary record of the current interval.
+        """
+        return {
+            'kind': 'summary',
+            'counts': self.counts,
+            'events': self.events,
+            'suppressed': self.events - self.sent,
+        }
 
-    def append(self, *strings):
+    def flush(self):
         """
-        Adds any number of supplied *strings* to `self` (we're a subclass of
-        `str` remember) just before the last closing tag and returns a new
-        instance of `~htmltag.HTML` with the result.
-        Example::
+        Sends a summary record with the counts of everything that was
+        rejected since the last flush (if anything was) and starts over.
+        """
+        with self._lock:
+            summary = self._summary() if self.events else None
+            self._reset(_timer())
+        if summary:
+            self.destination(summary)
 
-            >>> from htmltag import span, b
-            >>> html = span('Test:')
-            >>> print(html)
-            <span>Test:</span>
-            >>> html = html.append(' ', b('appended'))
-            >>> print(html)
-            <span>Test: <b>appended</b></span>
+# The TagWrap settings that policy() can override:
+_policy_options = frozenset([
+    'safe_mode', 'whitelist', 'replacement', 'log_rejects', 'reject_sink',
+    'ending_slash', 'sanitizer', 'attr_cache', 'metrics', 'lazy', 'compact'
+])
 
-        In the case of self-closing tags like '<img>' the string will simply be
-        appended after the tag::
+@contextmanager
+def policy(**settings):
+    """
+    .. versionadded:: 1.8.0
 
-            >>> from htmltag import img
-            >>> image = img(src="http://company.com/image.png")
-            >>> print(image.append("Appended string"))
-            <img src="http://company.com/image.png">Appended string
+    Overrides the given *settings* (anything :class:`TagWrap` accepts as a
+    keyword argument, e.g. `safe_mode`, `whitelist`, `replacement`, or
+    `sanitizer`) for every tag that gets called inside the ``with`` block::
 
-        .. note:: Why not update ourselves in-place?  Because we're a subclass
-            of `str`; in Python strings are immutable.
-        """
-        close_tag_start = self.rfind('</')
-        if self.tagname: # More accurate
-            close_tag_start = self.rfind('</'+self.tagname)
-        if close_tag_start == -1: # Couldn't find closing tag
-            return self + "".join(strings) # Just tack on to the end
-        ending = self[close_tag_start:]
-        beginning = self[:close_tag_start]
-        if self.tagname: # Preserve it
-            tagname = self.tagname
-            new = HTML(beginning + "".join(strings) + ending)
-            new.tagname = tagname
-            return new
-        else:
-            return HTML(beginning + "".join(strings) + ending)
+        >>> from htmltag import policy, HTML, TagWrap
+        >>> em = TagWrap('em')
+        >>> with policy(safe_mode=False):
+        ...     print(em(HTML('<i onclick="alert(1)">')))
+        <em><i onclick="alert(1)"></em>
+        >>> print(em(HTML('<i onclick="alert(1)">')))
+        <em>(removed)</em>
+
+    The overrides are kept in a `contextvars.ContextVar` so they only apply
+    to the current thread (or asyncio task) and the tags themselves never
+    get modified; nothing else that's using them will be affected.  Blocks
+    can be nested (the innermost settings win).
+
+    .. note:: Tags made with :meth:`TagWrap.bind` keep the settings they
+        were bound with.
+    """
+    unknown = set(settings) - _policy_options
+    if unknown:
+        raise TypeError("Unknown setting(s): %s" % ", ".join(sorted(unknown)))
+    current = _overrides.get()
+    merged = dict(current[1]) if current else {}
+    merged.update(settings)
+    key = tuple(sorted(
+        (name, frozenset(value) if isinstance(value, (list, set)) else value)
+        for name, value in merged.items()))
+    token = _overrides.set((key, merged))
+    try:
+        yield
+    finally:
+        _overrides.reset(token)
 
 class TagWrap(object):
     """
@@ -384,16 +3049,41 @@ class TagWrap(object):
         display as-is but won't be evaluated by renderers/browsers'.  The
         defaults is "(removed)".
     :keyword log_rejects: If `True` rejected unsafe (XSS) HTML will be
-        logged using :meth:`logging.error`.  Defaults to `False`
+        reported to *reject_sink* (which logs it using
+        :meth:`logging.error` by default).  Defaults to `False`
+    :keyword reject_sink: The :class:`RejectSink` to report rejected HTML to.
+        Defaults to `TagWrap.reject_sink`.
     :keyword ending_slash: If `True` self-closing HTML tags like '<img>'
         will not have a '/' placed before the '>'.  Usually only necessary
         with XML and XHTML documents (as opposed to regular HTML).  Defaults
         to `False`.
+    :keyword compact: If `True` the output will be made as small as it can be
+        without changing what it means to a browser (see
+        :meth:`~TagWrap.wrap`).  Defaults to `False`.
+    :keyword sanitizer: A :class:`Sanitizer` to use when *safe_mode* is
+        enabled (*whitelist* and *replacement* will be taken from it unless
+        given explicitly).  If not given a shared `Sanitizer` matching
+        *whitelist* and *replacement* will be used.
     :type safe_mode: boolean
     :type whitelist: iterable
     :type replacement: string, "entities", or "off"
     :type log_rejects: boolean
+    :keyword attr_cache: An :class:`AttrCache` to use for caching rendered
+        tags.  Defaults to `TagWrap.attr_cache` (`None`; no caching).
+    :keyword metrics: A :class:`Metrics` instance to collect statistics with.
+        Defaults to `TagWrap.metrics` (`None`; disabled).
+    :keyword lazy: If `True` calling the tag will return an :class:`Element`
+        instead of an :class:`HTML` string.  Elements form a tree that only
+        gets turned into a string (in one go) when it's finally needed.
+        A *key* keyword argument given to a lazy tag will be used by
+        :func:`diff` instead of being rendered.  Defaults to `False`.
     :type ending_slash: boolean
+    :type compact: boolean
+    :type sanitizer: :class:`Sanitizer`
+    :type attr_cache: :class:`AttrCache`
+    :type metrics: :class:`Metrics`
+    :type reject_sink: :class:`RejectSink`
+    :type lazy: boolean
 
     The `TagWrap` class may be used in a direct fashion (as opposed to the
     metaprogramming magic way: ``from htmltag import sometag``)::
@@ -430,6 +3120,26 @@ class TagWrap(object):
     .. note:: ``sys.modules[__name__]`` is the current module; the global 'self'.
     """
     # NOTE: The above doctest is skipped because it only works in reality :)
+    # Changing any of these will make us look up a new Sanitizer:
+    _policy_attrs = frozenset(['whitelist', 'replacement'])
+    # ...and these (which include the above) will make __call__ use a new
+    # render function (see _specialize()):
+    _render_attrs = _policy_attrs | frozenset(
+        ['tagname', 'safe_mode', 'ending_slash', 'compact'])
+    _render = None
+    # What `whitelist` held when `sanitizer` was looked up (if it's a list):
+    _whitelist_key = None
+    # Copies of this tag with the settings from policy() applied (an AttrCache
+    # of the most recently used ones so per-request settings don't pile up):
+    _variants = None
+    _max_variants = 32
+    # Set this to an AttrCache to cache rendered tags for all instances:
+    attr_cache = None
+    # Set this to a Metrics instance to collect statistics for all instances:
+    metrics = None
+    # Where rejected HTML gets reported when log_rejects is enabled:
+    reject_sink = RejectSink()
+
     def __init__(self, tagname, **kwargs):
         self.tagname = tagname
         self.safe_mode = kwargs.get('safe_mode', True)
@@ -438,14 +3148,76 @@ class TagWrap(object):
         self.log_rejects = kwargs.get('log_rejects', False)
         # This only applies to self-closing tags:
         self.ending_slash = kwargs.get('ending_slash', False)
+        self.compact = kwargs.get('compact', False)
+        self.lazy = kwargs.get('lazy', False)
+        if 'attr_cache' in kwargs: # Otherwise use the class-wide one
+            self.attr_cache = kwargs['attr_cache']
+        if 'metrics' in kwargs: # Ditto
+            self.metrics = kwargs['metrics']
+        if 'reject_sink' in kwargs: # Ditto
+            self.reject_sink = kwargs['reject_sink']
+        sanitizer = kwargs.get('sanitizer', None)
+        if sanitizer:
+            if 'whitelist' not in kwargs:
+                self.whitelist = sanitizer.whitelist or "off"
+            if 'replacement' not in kwargs:
+                self.replacement = sanitizer.replacement
+        self._sanitizer = sanitizer
+        self._whitelist_key = _whitelist_key(self.whitelist)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self._render_attrs:
+            object.__setattr__(self, '_render', None)
+            if name in self._policy_attrs:
+                object.__setattr__(self, '_sanitizer', None)
+        if self._variants and not name.startswith('_'):
+            object.__setattr__(self, '_variants', None) # Out of date
+
+    @property
+    def sanitizer(self):
+        """
+        The :class:`Sanitizer` that will be used when `safe_mode` is enabled.
+        It will be looked up again whenever `whitelist` or `replacement` are
+        changed (including changes made to a `whitelist` list in-place)::
+
+            >>> b = TagWrap('b', whitelist=['b'])
+            >>> b.sanitizer is TagWrap('i', whitelist=['b']).sanitizer
+            True
+            >>> b.replacement = "entities"
+            >>> b.sanitizer.replacement
+            'entities'
+            >>> b.whitelist.append('em')
+            >>> sorted(b.sanitizer.whitelist)
+            ['b', 'em']
+        """
+        sanitizer = self._sanitizer
+        if sanitizer is None or self._whitelist_changed():
+            sanitizer = Sanitizer.get(self.whitelist, self.replacement)
+            self._sanitizer = sanitizer
+            self._whitelist_key = _whitelist_key(self.whitelist)
+        return sanitizer
+
+    def _whitelist_changed(self):
+        """
+        Returns `True` if `whitelist` (a list or set) has been modified
+        in-place since `sanitizer` was looked up.
+        """
+        key = self._whitelist_key
+        return key is not None and key != frozenset(self.whitelist)
 
     def escape(self, string):
         """
         Returns *string* with all instances of '<', '>', and '&' converted into
-        HTML entities.
+        HTML entities.  The items of any other iterable (e.g. a list of
+        strings) are treated like the characters of a string would be::
+
+            >>> print(TagWrap('td')(['a', '<b>', '&']))
+            <td>a<b>&amp;</td>
         """
-        html_entities = {"&": "&amp;", '<': '&lt;', '>': '&gt;'}
-        return HTML("".join(html_entities.get(c, c) for c in string))
+        if isinstance(string, _string_types):
+            return HTML(escape(string))
+        return HTML("".join(_entities.get(c, c) for c in string))
 
     def wrap(self, tag, *args, **kwargs):
         """
@@ -461,24 +3233,84 @@ class TagWrap(object):
             >>> print(a('awesome software', href='http://liftoffsoftware.com/'))
             <a href="http://liftoffsoftware.com/">awesome software</a>
 
+        If `compact` is enabled the same HTML will be produced using as few
+        bytes as possible:  Attribute values are only quoted when they need to
+        be, boolean attributes (e.g. ``checked="checked"``) and empty ones
+        lose their values, self-closing tags never get an `ending_slash`, and
+        the end tags of any '<li>', '<td>', '<th>', '<tr>', or '<p>' children
+        are left out where the HTML spec allows it::
+
+            >>> ul = TagWrap('ul', compact=True)
+            >>> li = ul.copy('li')
+            >>> print(ul(li('One', _class="first"), li('Two & three')))
+            <ul><li class=first>One<li>Two &amp; three</ul>
+            >>> print(TagWrap('input', compact=True)(
+            ...     type="checkbox", checked="checked", value="a b"))
+            <input type=checkbox checked value="a b">
+
+        .. note:: It's the parent that decides whether or not its children's
+            end tags can be left out (based on what follows them) so a
+            '<li>' on its own will still have its '</li>'.  Children that
+            are lazy :class:`Element` trees are left as-is and a '</p>' is
+            only left out when a block-level element (e.g. another '<p>')
+            comes right after it.
+
         .. note:: :meth:`~TagWrap.wrap` will automatically convert '<', '>', \
         and '&' into HTML entities unless the wrapped string has an `__html__` \
         method
+
+        .. note:: When *safe_mode* is enabled only the parts this call adds \
+        (the tag itself and any `__html__` strings that weren't produced under \
+        the same :class:`Sanitizer`) get scanned; children that were already \
+        sanitized by the same policy are left alone.
         """
-        template = "<{tagstart}>{content}</{tag}>"
-        if tag in self_closing_tags:
-            template = "<{tagstart}>" # self-closing tags don't have content
-            if self.ending_slash:
-                template = "<{tagstart} />"
-        content = ""
-        for string in args:
-            if not hasattr(string, '__html__'): # Indicates already escaped
-                string = self.escape(string)
-            content += string.__html__()
+        kwargs, key = self._split_key(kwargs)
+        opening, closing = self._tags(tag, kwargs)
+        sanitizer = self.sanitizer if self.safe_mode else None
+        return self._build(tag, (opening, False), (closing, False), args,
+            sanitizer, kwargs, key)
+
+    def _split_key(self, attrs):
+        """
+        Returns a tuple containing *attrs* (dict) without 'key' and the value
+        of 'key' (`None` if there isn't one).  It's only taken out if `lazy`
+        is enabled (see :func:`diff`); otherwise it's just another attribute.
+        """
+        if not self.lazy or 'key' not in attrs:
+            return (attrs, None)
+        attrs = dict(attrs)
+        key = attrs.pop('key')
+        return (attrs, key)
+
+    def _tags(self, tag, attrs):
+        """
+        Returns a tuple containing the opening and closing tags (strings) for
+        *tag* with the given *attrs* (dict).  The closing tag will be an
+        empty string for self-closing tags.
+        """
+        cache = self.attr_cache
+        if cache is None or not attrs:
+            return self._render_tags(tag, attrs)
+        try:
+            key = (tag, self.ending_slash, self.compact, tuple(attrs.items()))
+            tags = cache.get(key)
+        except TypeError: # Unhashable attribute value
+            return self._render_tags(tag, attrs)
+        if tags is None:
+            tags = self._render_tags(tag, attrs)
+            cache.set(key, tags)
+        return tags
+
+    def _render_tags(self, tag, attrs):
+        """
+        Does the work for :meth:`~TagWrap._tags` (without caching).
+        """
+        if self.compact:
+            return _compact_tags(tag, attrs)
         tagstart = tag
-        if kwargs:
+        if attrs:
             tagstart += ' '
-            for key, value in kwargs.items():
+            for key, value in attrs.items():
                 key = key.lstrip('_')
                 if value == True:
                     tagstart = tagstart + key + ' '
@@ -488,36 +3320,246 @@ class TagWrap(object):
                     tagstart = tagstart + '{key}="{value}" '.format(
                         key=key, value=value)
             tagstart = tagstart.rstrip()
-        html = template.format(tagstart=tagstart, content=content, tag=tag)
-        if self.safe_mode:
-            html, rejected = strip_xss(
-                html, whitelist=self.whitelist, replacement=self.replacement)
-            if self.log_rejects:
-                logging.error(
-                    "{name} rejected unsafe HTML: '{rejected}'".format(
-                    name=self.__class__.__name__, rejected=rejected))
-        html = HTML(html)
-        html.tagname = tag # So we can easily append()
+        if tag in self_closing_tags:
+            if self.ending_slash:
+                return ("<" + tagstart + " />", "")
+            return ("<" + tagstart + ">", "")
+        return ("<" + tagstart + ">", "</" + tag + ">")
+
+    def _build(self, tag, opening, closing, args, sanitizer,
+               attrs=None, key=None):
+        """
+        Returns the result of wrapping *args* in *tag* given the *opening* and
+        *closing* ``(text, trusted)`` tags and the *sanitizer* to use (if
+        any).  Returns an :class:`Element` (with the given *attrs* and *key*)
+        if `lazy` is enabled.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            return metrics.measure('wrap', tag, self._assemble,
+                tag, opening, closing, args, sanitizer, attrs, key)
+        return self._assemble(
+            tag, opening, closing, args, sanitizer, attrs, key)
+
+    def _assemble(self, tag, opening, closing, args, sanitizer,
+                  attrs=None, key=None):
+        """
+        Does the work for :meth:`~TagWrap._build` (and updates `metrics`).
+        """
+        children = []
+        if closing[0]: # self-closing tags don't have content
+            if self.compact:
+                tagnames = []
+                children = self._children(args, sanitizer, tagnames)
+                _omit_end_tags(children, tagnames)
+            else:
+                children = self._children(args, sanitizer)
+        metrics = self.metrics
+        if self.lazy:
+            if metrics is not None:
+                metrics.record(tag)
+            return Element(tag, opening, children, closing, sanitizer, self,
+                attrs, key)
+        if metrics is not None and sanitizer:
+            scanner = metrics.measure('sanitize', tag,
+                _scan_pieces, sanitizer, opening, children, closing)
+        else:
+            scanner = _scan_pieces(sanitizer, opening, children, closing)
+        self._log_rejects(scanner.rejected, tag)
+        html = HTML._make("".join(scanner.out), tag,
+            sanitizer if scanner.trusted else None)
+        if metrics is not None:
+            metrics.record(tag, len(html), len(scanner.rejected))
         return html
 
-    def copy(self, tagname, **kwargs):
+    def bind(self, **attrs):
+        """
+        .. versionadded:: 1.8.0
+
+        Returns a :class:`BoundTag`: a callable that works just like this tag
+        but always includes the given *attrs*.  The opening and closing tags
+        are rendered (and sanitized) once, ahead of time, so calling it only
+        has to deal with the content::
+
+            >>> td = TagWrap('td')
+            >>> num = td.bind(_class="num", align="right")
+            >>> print(num('42'))
+            <td class="num" align="right">42</td>
+
+        Keyword arguments given at call time will be merged with the bound
+        attributes (taking precedence)::
+
+            >>> print(num('43', _class="num total"))
+            <td class="num total" align="right">43</td>
+
+        .. note:: The returned `BoundTag` uses this tag's settings (e.g.
+            `safe_mode`) as they were when :meth:`~TagWrap.bind` was called.
+        """
+        return BoundTag(self, attrs)
+
+    def builder(self, *args, **kwargs):
+        """
+        .. versionadded:: 1.8.0
+
+        Returns an :class:`HTMLBuilder` for the tag made with the given
+        *args* and *kwargs* (same as calling this tag) so more can be added
+        to it efficiently::
+
+            >>> tr, td = TagWrap('tr'), TagWrap('td')
+            >>> row = tr.builder(td('first'), _class="odd")
+            >>> print(row.append(td('second')).build())
+            <tr class="odd"><td>first</td><td>second</td></tr>
+        """
+        return HTMLBuilder(self(*args, **kwargs))
+
+    def _children(self, args, sanitizer, tagnames=None):
+        """
+        Returns a list of *args* converted into :class:`Element` instances
+        (as-is) and ``(text, trusted)`` tuples (everything else).  Strings
+        without an `__html__` method will be escaped.  Iterators will be
+        expanded (or deferred until rendering if `lazy` is enabled).
+
+        If a *tagnames* list is given the `tagname` of each child (`None` if
+        it doesn't have one) will be appended to it.
+        """
+        children = []
+        plain = type(self).escape is TagWrap.escape # Not overridden
+        for string in args:
+            if isinstance(string, Element):
+                children.append(string)
+            elif _is_iterator(string):
+                if self.lazy:
+                    children.append(_Deferred(string, self, sanitizer))
+                else:
+                    children.extend(
+                        self._children(string, sanitizer, tagnames))
+                    continue
+            elif not hasattr(string, '__html__'): # Indicates already escaped
+                if plain and isinstance(string, _string_types):
+                    children.append((escape(string), True))
+                else: # Could be anything (see escape())
+                    children.append((self.escape(string), False))
+            else:
+                trusted = getattr(string, 'sanitized_by', None) is sanitizer
+                children.append((string.__html__(), trusted))
+            if tagnames is not None:
+                tagnames.append(getattr(string, 'tagname', None))
+        return children
+
+    def _log_rejects(self, rejected, tagname):
+        """
+        Reports the *rejected* tags (if there are any) to our `reject_sink`
+        if `log_rejects` is enabled.
+        """
+        if rejected and self.log_rejects:
+            self.reject_sink.report(
+                self.__class__.__name__, tagname, rejected)
+
+    def copy(self, tagname=None, **kwargs):
         """
-        Returns a new instance of `TagWrap` using the given *tagname* that has
-        all the same attributes as this instance.  If *kwargs* is given they
-        will override the attributes of the created instance.
+        Returns a new instance of `TagWrap` using the given *tagname* (or the
+        same one) that has all the same attributes as this instance.  If
+        *kwargs* is given they will override the attributes of the created
+        instance.  Handy for using different settings without changing a
+        (shared) tag::
+
+            >>> b = TagWrap('b')
+            >>> raw_b = b.copy(safe_mode=False)
+            >>> print(raw_b(HTML('<i onclick="alert(1)">')))
+            <b><i onclick="alert(1)"></b>
+            >>> print(b(HTML('<i onclick="alert(1)">')))
+            <b>(removed)</b>
         """
+        if tagname is None:
+            tagname = self.tagname
         new_kwargs = {
             'replacement': self.replacement,
             'whitelist': self.whitelist,
             'safe_mode': self.safe_mode,
             'log_rejects': self.log_rejects,
-            'ending_slash': self.ending_slash
+            'ending_slash': self.ending_slash,
+            'compact': self.compact,
+            'lazy': self.lazy
         }
+        if 'attr_cache' in self.__dict__:
+            new_kwargs['attr_cache'] = self.attr_cache
+        if 'metrics' in self.__dict__:
+            new_kwargs['metrics'] = self.metrics
+        if 'reject_sink' in self.__dict__:
+            new_kwargs['reject_sink'] = self.reject_sink
+        if 'whitelist' not in kwargs and 'replacement' not in kwargs:
+            new_kwargs['sanitizer'] = self.sanitizer
         new_kwargs.update(**kwargs)
         return TagWrap(tagname, **new_kwargs)
 
+    def _specialize(self):
+        """
+        Returns a function that takes the *args* and *kwargs* given to
+        :meth:`~TagWrap.__call__` and does what :meth:`~TagWrap.wrap` would
+        do with them given our current settings.  Everything that doesn't
+        depend on the arguments (the sanitizer, whether or not the tag is
+        self-closing, the opening and closing tags when there are no
+        attributes, etc) is worked out ahead of time.
+        """
+        tag = self.tagname
+        if type(self).wrap is not TagWrap.wrap: # Subclass knows best
+            wrap = self.wrap
+            return lambda args, kwargs: wrap(tag, *args, **kwargs)
+        sanitizer = self.sanitizer if self.safe_mode else None
+        tags, build = self._tags, self._build
+        opening, closing = self._render_tags(tag, None)
+        opening = _prescan(sanitizer, opening)
+        closing = _prescan(sanitizer, closing)
+        split_key = self._split_key
+        def render(args, kwargs):
+            if kwargs:
+                kwargs, key = split_key(kwargs)
+                with_attrs, end = tags(tag, kwargs)
+                return build(tag, (with_attrs, False), (end, False), args,
+                    sanitizer, kwargs, key)
+            return build(tag, opening, closing, args, sanitizer)
+        return render
+
+    def _overridden(self, overrides):
+        """
+        Returns a copy of this tag with the settings from :func:`policy`
+        (*overrides*) applied.  The most recently used copies get reused
+        until our own settings change.
+        """
+        key, settings = overrides
+        variants = self._variants
+        if variants is None:
+            variants = AttrCache(maxsize=self._max_variants)
+            object.__setattr__(self, '_variants', variants)
+        variant = variants.get(key)
+        if variant is not None:
+            return variant
+        variant = object.__new__(type(self))
+        variant.__dict__.update(self.__dict__)
+        variant.__dict__.pop('_render', None)
+        variant.__dict__.pop('_variants', None)
+        for name, value in settings.items():
+            if name != 'sanitizer':
+                setattr(variant, name, value)
+        sanitizer = settings.get('sanitizer')
+        if sanitizer: # Same as passing it to __init__()
+            if 'whitelist' not in settings:
+                variant.whitelist = sanitizer.whitelist or "off"
+            if 'replacement' not in settings:
+                variant.replacement = sanitizer.replacement
+            variant._sanitizer = sanitizer
+            variant._whitelist_key = _whitelist_key(variant.whitelist)
+        variants.set(key, variant)
+        return variant
+
     def __call__(self, *args, **kwargs):
-        return self.wrap(self.tagname, *args, **kwargs)
+        overrides = _overrides.get()
+        tag = self if overrides is None else self._overridden(overrides)
+        render = tag._render
+        if render is None or (
+                tag._whitelist_key is not None and tag._whitelist_changed()):
+            render = tag._render = tag._specialize()
+        return render(args, kwargs)
 
     def __getitem__(self, k):
         if k == "__all__":
@@ -531,6 +3573,483 @@ class TagWrap(object):
             "Using IPython?  Ignore that ^ traceback stuff and try again "
             "(second time usually works to get your traceback)")
 
+class BoundTag(object):
+    """
+    .. versionadded:: 1.8.0
+
+    A :class:`TagWrap` with a fixed set of attributes (see
+    :meth:`TagWrap.bind`).
+    """
+    __slots__ = (
+        'wrapper', 'attrs', 'sanitizer', 'key', '_attrs', '_opening',
+        '_closing')
+
+    def __init__(self, wrapper, attrs):
+        self.wrapper = wrapper
+        self.attrs = attrs
+        sanitizer = wrapper.sanitizer if wrapper.safe_mode else None
+        self.sanitizer = sanitizer
+        self._attrs, self.key = wrapper._split_key(attrs)
+        opening, closing = wrapper._tags(wrapper.tagname, self._attrs)
+        self._opening = _prescan(sanitizer, opening)
+        self._closing = _prescan(sanitizer, closing)
+
+    def bind(self, **attrs):
+        """
+        Returns a new `BoundTag` with *attrs* added to our own.
+        """
+        new_attrs = dict(self.attrs)
+        new_attrs.update(attrs)
+        return BoundTag(self.wrapper, new_attrs)
+
+    def __call__(self, *args, **kwargs):
+        wrapper = self.wrapper
+        if kwargs:
+            attrs = dict(self.attrs)
+            attrs.update(kwargs)
+            attrs, key = wrapper._split_key(attrs)
+            opening, closing = wrapper._tags(wrapper.tagname, attrs)
+            return wrapper._build(wrapper.tagname, (opening, False),
+                (closing, False), args, self.sanitizer, attrs, key)
+        return wrapper._build(wrapper.tagname, self._opening, self._closing,
+            args, self.sanitizer, self._attrs, self.key)
+
+def _prescan(sanitizer, tag):
+    """
+    Returns a ``(text, trusted)`` tuple for the given opening or closing
+    *tag*.  It will only be *trusted* if *sanitizer* had nothing to say
+    about it (so it can be used as-is from then on).
+    """
+    if not sanitizer or not tag:
+        return (tag, True)
+    html, bad_tags, rest = sanitizer._scan(tag, False)
+    if bad_tags or rest:
+        return (tag, False) # Scan it every time so rejects get logged
+    return (tag, True)
+
+def _compact_tags(tag, attrs):
+    """
+    Returns a tuple containing the opening and closing tags for *tag* with
+    the given *attrs* (dict) made as small as possible (see
+    :meth:`TagWrap.wrap`).  The results are interned since the same few tags
+    tend to get rendered over and over again.
+    """
+    tagstart = tag
+    if attrs:
+        for key, value in attrs.items():
+            key = key.lstrip('_')
+            if value == True:
+                tagstart += ' ' + key
+                continue
+            elif value == False:
+                continue # skip it altogether
+            value = '{0}'.format(value)
+            if not value or (key.lower() in _boolean_attributes
+                    and value.lower() == key.lower()):
+                tagstart += ' ' + key
+            elif _unquoted_value_re.match(value):
+                tagstart += ' ' + key + '=' + value
+            else:
+                tagstart += ' {key}="{value}"'.format(key=key, value=value)
+    if tag in self_closing_tags:
+        return (_intern("<" + tagstart + ">"), "")
+    return (_intern("<" + tagstart + ">"), _intern("</" + tag + ">"))
+
+def _omit_end_tags(children, tagnames):
+    """
+    Removes the end tags that aren't needed from *children* (as returned by
+    :meth:`TagWrap._children`) in-place.  Whether or not an end tag can be
+    left out depends on what comes after it (the `tagname` of the next
+    child in *tagnames*) so it's up to the parent to decide.
+    """
+    following = tagnames[1:]
+    following.append('')
+    for i, tagname in enumerate(tagnames):
+        if following[i] not in _optional_end_tags.get(tagname, ()):
+            continue
+        child = children[i]
+        if isinstance(child, tuple): # Not an Element
+            text, trusted = child
+            end = "</" + tagname + ">"
+            if text.endswith(end):
+                children[i] = (text[:-len(end)], trusted)
+
+class _Placeholder(stringtype):
+    """
+    Stands in for an argument while a :class:`Template` is being traced.
+    Keeps track of how many times it was used as text (`escaped`) and as an
+    attribute value (`formatted`) so we can tell if any of those uses didn't
+    make it into the result (e.g. a tag that got removed by a sanitizer).
+    """
+    escaped = formatted = 0
+
+    def replace(self, old, new, *args): # Only escape() calls this
+        self.escaped += 1
+        return stringtype.replace(self, old, new, *args)
+
+    def __format__(self, spec):
+        self.formatted += 1
+        return stringtype.__format__(self, spec)
+
+# Characters that could change how a tag gets parsed if they were in an
+# attribute value (see Template):
+_unsafe_value_re = re.compile(r'["\'<>\n]')
+
+class Template(object):
+    """
+    .. versionadded:: 1.8.0
+
+    A function that builds HTML out of tags (*fn*), compiled so that calling
+    it only has to escape and insert its arguments (see :func:`compile`).
+
+    The first time it's called (with a given number of positional arguments
+    and set of keyword arguments) *fn* gets called with a unique placeholder
+    string in place of each argument.  Where those placeholders end up in the
+    result is worked out and from then on the result is put together from
+    the (constant) parts around them and the (escaped) arguments.  That only
+    happens when it's safe:
+
+    * Each argument must end up as text (between tags) or inside a quoted
+      attribute value without being changed in any way other than being
+      escaped.  If not (e.g. *fn* calls a method on it, loops over it, or
+      uses it as a tag or attribute name) *fn* will always be called instead.
+      That includes attribute values of `compact` tags (see
+      :class:`TagWrap`) since whether they get quoted (or even kept)
+      depends on the value::
+
+        >>> a = TagWrap('a', compact=True)
+        >>> link = compile(lambda text, href: a(text, href=href))
+        >>> print(link("Home", "b"))
+        <a href=b>Home</a>
+        >>> link("Home", "b") == a("Home", href="b")
+        True
+
+    * Only strings get inserted directly.  Anything else (e.g.
+      :class:`HTML`, numbers, or lists) gets passed to *fn* like normal.
+    * An attribute value containing quotes, '<', '>', or a newline (or that
+      would make the tag unsafe) also results in calling *fn*.  So does one
+      that starts with a URL scheme if a sanitizer with a *schemes* policy
+      (see :class:`Sanitizer`) would look at it.
+
+    .. note:: Since *fn* doesn't get called for most arguments it shouldn't
+        have side effects or make decisions based on the values of its
+        arguments.  Tag settings (e.g. `safe_mode`) that were in effect the
+        first time around will continue to be used; call :meth:`clear` if
+        you change them.  :class:`Metrics` will only see the calls to *fn*.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self._renderers = {}
+
+    def __call__(self, *args, **kwargs):
+        if kwargs:
+            names = tuple(sorted(kwargs))
+            values = args + tuple(kwargs[name] for name in names)
+        else:
+            names = ()
+            values = args
+        key = (len(args), names)
+        render = self._renderers.get(key)
+        if render is None:
+            render = self._renderers[key] = self._compile(len(args), names)
+        if render:
+            html = render(values)
+            if html is not None:
+                return html
+        return self.fn(*args, **kwargs)
+
+    def clear(self):
+        """
+        Forgets everything that was worked out about *fn* so that it'll be
+        traced again next time.
+        """
+        self._renderers.clear()
+
+    def _placeholders(self, total, prefix=''):
+        """
+        Returns a list of *total* unique :class:`_Placeholder` strings
+        starting with *prefix*.  They include an '&' (so we can tell if they
+        were escaped) and a non-ASCII character (so we can tell if they were
+        turned into character references).
+        """
+        return [_Placeholder('%s\xe9&Hole%sx%x' % (prefix, i, id(self)))
+                for i in range(total)]
+
+    def _compile(self, count, names):
+        """
+        Returns a function that takes the values of the *count* positional
+        arguments (followed by the keyword arguments with the given *names*)
+        and returns what *fn* would (or `None` if it has to be called after
+        all).  Returns `False` if *fn* always has to be called.
+        """
+        markers = self._placeholders(count + len(names))
+        cores = [marker[2:] for marker in markers] # Minus the '\xe9&'
+        try:
+            html = self.fn(*markers[:count], **dict(zip(names, markers[count:])))
+        except Exception: # Needs real values
+            return False
+        if not isinstance(html, HTML):
+            return False # e.g. a lazy Element
+        holes = [] # (start, end, index, in_attribute)
+        for index, marker in enumerate(markers):
+            found = len(holes)
+            text = stringtype(marker)
+            for text, in_attribute in ((text, True), (escape(text), False)):
+                pos = html.find(text)
+                while pos >= 0:
+                    holes.append((pos, pos + len(text), index, in_attribute))
+                    pos = html.find(text, pos + len(text))
+            if not found < len(holes) == found + html.count(cores[index]):
+                return False # It (or a copy of it) got changed somehow
+            in_attributes = sum(hole[3] for hole in holes[found:])
+            if (marker.formatted != in_attributes or
+                    marker.escaped != len(holes) - found - in_attributes):
+                return False # Not every use made it into the result
+        finder = _TracingFinder(_tag_finder)
+        tags = finder.tags(html)
+        cuts = set([0, len(html)])
+        checked = set() # Tags with attribute holes (is_safe() gets rechecked)
+        for start, end, index, in_attribute in holes:
+            if _overlaps(finder.looked, start, end):
+                return False # Whatever gets put here could change the tags
+            tag = [t for t in tags if t[0] < start and end < t[1]]
+            if in_attribute != bool(tag):
+                return False
+            if not in_attribute and _overlaps(finder.skimmed, start, end):
+                return False
+            cuts.update((start, end))
+            checked.update(tag)
+        for tag in checked:
+            cuts.update(tag)
+        cuts = sorted(cuts)
+        slots = dict((start, i) for i, start in enumerate(cuts))
+        parts = [html[start:end] for start, end in zip(cuts, cuts[1:])]
+        text_holes = []
+        attr_holes = []
+        for start, end, index, in_attribute in holes:
+            parts[slots[start]] = None
+            (attr_holes if in_attribute else text_holes).append(
+                (slots[start], index))
+        checks = [(slots[start], slots[end]) for start, end in checked]
+        is_safe = Sanitizer.get("off").is_safe
+        if attr_holes and not self._schemeless(count, names, html, holes):
+            is_safe = Sanitizer.get("off", schemes=()).is_safe
+        tagname, sanitized_by = html.tagname, html.sanitized_by
+        def render(values):
+            out = list(parts)
+            for slot, index in text_holes:
+                value = values[index]
+                if type(value) is not stringtype:
+                    return None
+                out[slot] = escape(value)
+            for slot, index in attr_holes:
+                value = values[index]
+                if type(value) is not stringtype or _unsafe_value_re.search(
+                        value):
+                    return None
+                out[slot] = value
+            for first, last in checks:
+                if not is_safe("".join(out[first:last])):
+                    return None
+            return HTML._make("".join(out), tagname, sanitized_by)
+        return render
+
+    def _schemeless(self, count, names, html, holes):
+        """
+        Returns `True` if the URL schemes of the attributes *fn* puts its
+        arguments in can't depend on them.  Checked by tracing *fn* again
+        (the traced result was *html*) with a made up scheme in front of
+        each placeholder; if any sanitizer with a *schemes* policy notices
+        that the result won't be the same.
+        """
+        prefix = 'x%x:' % id(self)
+        probes = self._placeholders(count + len(names), prefix)
+        try:
+            probed = self.fn(*probes[:count], **dict(zip(names, probes[count:])))
+        except Exception:
+            return False
+        starts = [0] + sorted(hole[0] for hole in holes) + [len(html)]
+        return probed == prefix.join(
+            html[start:end] for start, end in zip(starts, starts[1:]))
+
+def compile(fn):
+    """
+    .. versionadded:: 1.8.0
+
+    Returns a :class:`Template` for *fn*:  A function that builds the same
+    structure out of tags every time, only with different values.  Calling it
+    gives the same result as calling *fn* but the tags only get called (and
+    their attributes formatted and sanitized) once; after that the arguments
+    just get escaped and inserted.  It can also be used as a decorator::
+
+        >>> from htmltag import compile, div, h2, p
+        >>> @compile
+        ... def card(title, body, kind="card"):
+        ...     return div(h2(title), p(body), _class=kind)
+        >>> print(card("Hello & welcome", "<b>Not bold</b>"))
+        <div class="card"><h2>Hello &amp; welcome</h2><p>&lt;b&gt;Not bold&lt;/b&gt;</p></div>
+        >>> print(card("Again", "Fast", kind="card wide"))
+        <div class="card wide"><h2>Again</h2><p>Fast</p></div>
+        >>> card("x", "y") == div(h2("x"), p("y"), _class="card")
+        True
+
+    See :class:`Template` for the fine print.
+    """
+    return Template(fn)
+
+def render_table(data, headers=None, cell_attrs=None, wrapper=None, **attrs):
+    """
+    .. versionadded:: 1.8.0
+
+    Returns an :class:`HTML` '<table>' containing *data*; the same thing you'd
+    get by building it the normal way (one `td` per cell, one `tr` per row)
+    but much faster since the cells get converted one column at a time:
+    numeric columns don't need any escaping at all and string columns are
+    escaped in one go (see :func:`escape_many`).
+
+    *data* may be a list of rows, a dict of columns (name: values), or a 2D
+    NumPy array (really, anything with a `tolist()` method).  Cell values that
+    aren't strings will be converted using `str()`; values that have an
+    `__html__` method are treated just like they would be by :class:`TagWrap`.
+
+    :param headers: A list of column headings.  If *data* is a dict they'll
+        default to its keys.
+    :param cell_attrs: A dict of attributes to add to every '<td>' or a list
+        containing one dict for each column.
+    :param wrapper: A :class:`TagWrap` whose settings (`safe_mode`,
+        `whitelist`, `compact`, etc) will be used for all the tags.
+    :param attrs: Attributes for the '<table>' tag itself.
+
+    Example::
+
+        >>> print(render_table(
+        ...     [["Widget", 4, 1.5], ["Gadget & co", 10, 0.25]],
+        ...     headers=["Name", "Qty", "Price"],
+        ...     cell_attrs=[{}, {'align': 'right'}, {'align': 'right'}],
+        ...     _class="report"))
+        <table class="report"><tr><th>Name</th><th>Qty</th><th>Price</th></tr><tr><td>Widget</td><td align="right">4</td><td align="right">1.5</td></tr><tr><td>Gadget &amp; co</td><td align="right">10</td><td align="right">0.25</td></tr></table>
+
+    A flat list (or 1D array) becomes a single column::
+
+        >>> print(render_table([1, 2], headers=["n"]))
+        <table><tr><th>n</th></tr><tr><td>1</td></tr><tr><td>2</td></tr></table>
+    """
+    if wrapper is None:
+        wrapper = TagWrap('table')
+    table, tr, td, th = [
+        wrapper.copy(tag, lazy=False) for tag in ('table', 'tr', 'td', 'th')]
+    sanitizer = table.sanitizer if table.safe_mode else None
+    headers, columns, count = _table_columns(data, headers)
+    if cell_attrs is None or isinstance(cell_attrs, dict):
+        cell_attrs = [cell_attrs or {}] * len(columns)
+    elif count and len(cell_attrs) != len(columns):
+        raise ValueError("Got %d cell_attrs for %d columns" % (
+            len(cell_attrs), len(columns)))
+    cells = [_table_cells(values, td.bind(**col_attrs), sanitizer)
+        for values, col_attrs in zip(columns, cell_attrs)]
+    rows = []
+    row_end = "" if table.compact else "</tr>" # Rows only follow rows
+    row_tags = _prescan(sanitizer, "<tr>"), _prescan(sanitizer, row_end)
+    if headers is not None:
+        texts, untrusted = _table_cells(list(headers), th.bind(), sanitizer)
+        rows.append(_table_row(tr, row_tags, texts, not untrusted, sanitizer))
+    untrusted = set()
+    for texts, column_untrusted in cells:
+        untrusted.update(column_untrusted)
+    for i in range(count): # Rows can be empty (no columns at all)
+        row = [texts[i] for texts, column_untrusted in cells]
+        rows.append(_table_row(
+            tr, row_tags, row, i not in untrusted, sanitizer))
+    opening, closing = table._tags('table', attrs)
+    opening = _prescan(sanitizer, opening)
+    closing = _prescan(sanitizer, closing)
+    if opening[1] and closing[1] and all(row[1] for row in rows):
+        html = opening[0] + "".join([row[0] for row in rows]) + closing[0]
+        return HTML._make(html, 'table', sanitizer)
+    return table(*[HTML._make(row[0], 'tr', sanitizer if row[1] else None)
+        for row in rows], **attrs)
+
+def _table_columns(data, headers):
+    """
+    Returns a tuple of ``(headers, columns, count)`` for the given *data*
+    (see :func:`render_table`) where *count* is the number of rows.
+    """
+    if isinstance(data, dict):
+        if headers is None:
+            headers = list(data.keys())
+        columns = [list(_tolist(values)) for values in data.values()]
+        count = len(columns[0]) if columns else 0
+    else:
+        rows = list(_tolist(data))
+        if rows and not isinstance(_tolist(rows[0]), (list, tuple)):
+            rows = [[row] for row in rows] # 1D array
+        else:
+            rows = [list(_tolist(row)) for row in rows]
+        if any(len(row) != len(rows[0]) for row in rows):
+            raise ValueError("All rows must have the same number of cells")
+        columns = [list(column) for column in zip(*rows)]
+        count = len(rows)
+    if any(len(column) != len(columns[0]) for column in columns):
+        raise ValueError("All columns must have the same number of cells")
+    if count and headers is not None and len(headers) != len(columns):
+        raise ValueError(
+            "Got %d headers for %d columns" % (len(headers), len(columns)))
+    return (headers, columns, count)
+
+def _tolist(values):
+    """
+    Converts NumPy arrays (or anything else with a `tolist()` method) into
+    lists.  Everything else is returned as-is.
+    """
+    tolist = getattr(values, 'tolist', None)
+    return tolist() if tolist else values
+
+if sys.version_info.major == 2:
+    _numeric_types = frozenset([int, long, float, bool])
+else: # Python 3
+    _numeric_types = frozenset([int, float, bool])
+
+def _table_cells(values, cell, sanitizer):
+    """
+    Renders a whole column of *values* using the given *cell* (a
+    :class:`BoundTag`).  Returns a tuple containing a list of the rendered
+    cells and a `set()` of the indexes of the ones that aren't trusted
+    (sanitized by *sanitizer*).
+    """
+    opening, closing = cell._opening, cell._closing
+    compact = cell.wrapper.compact
+    types = set(map(type, values))
+    if (not opening[1] or not closing[1]
+            or any(hasattr(t, '__html__') for t in types)):
+        # Do it the normal way
+        cells = [cell(value if hasattr(value, '__html__')
+            else stringtype(value)) for value in values]
+        untrusted = set(i for i, html in enumerate(cells)
+            if sanitizer and html.sanitized_by is not sanitizer)
+        if compact: # Cells are always followed by cells (or nothing)
+            end = closing[0]
+            cells = [HTML._make(html[:-len(end)], html.tagname,
+                html.sanitized_by) if html.endswith(end) else html
+                for html in cells]
+        return (cells, untrusted)
+    texts = [stringtype(value) for value in values]
+    if not types <= _numeric_types: # Numbers never need to be escaped
+        texts = escape_many(texts)
+    opening, closing = opening[0], "" if compact else closing[0]
+    return ([opening + text + closing for text in texts], set())
+
+def _table_row(tr, row_tags, cells, trusted, sanitizer):
+    """
+    Returns a ``(html, trusted)`` tuple for a row containing the rendered
+    *cells*.  *trusted* indicates whether all the *cells* are trusted.
+    """
+    opening, closing = row_tags
+    if trusted and opening[1] and closing[1]:
+        return (opening[0] + "".join(cells) + closing[0], True)
+    row = tr(*[cell if isinstance(cell, HTML)
+        else HTML._make(cell, 'td', sanitizer) for cell in cells])
+    return (row, not sanitizer or row.sanitized_by is sanitizer)
+
 class SelfWrap(ModuleType):
     """
     This class is the magic that lets us do things like::
@@ -542,9 +4061,14 @@ class SelfWrap(ModuleType):
         # This is necessary for reload() to work and so we don't overwrite
         # these values with instances of TagWrap:
         no_override = [
-            'HTML', 'SelfWrap', 'TagWrap', 'strip_xss', '__author__',
-            '__builtins__', '__doc__', '__license__', '__name__',
-            '__package__', '__version__', '__version_info__'
+            'AttrCache', 'BoundTag', 'Element', 'FragmentCache', 'HTML',
+            'HTMLBuilder', 'Metrics', 'Patch', 'RejectSink', 'SanitizeCache',
+            'Sanitizer', 'SelfWrap', 'TagWrap', 'Template', 'cached',
+            'compile', 'diff', 'escape', 'escape_many', 'invalidate',
+            'policy', 'render_table', 'strip_xss', 'strip_xss_many',
+            '_sanitize_with', # So Sanitizer.map() can pickle it
+            '__author__', '__builtins__', '__doc__', '__license__',
+            '__name__', '__package__', '__version__', '__version_info__'
         ]
         for attr in no_override:
             setattr(self, attr, getattr(tagname, attr, None))
@@ -552,11 +4076,11 @@ class SelfWrap(ModuleType):
         self.__file__ = FILE # Needed for Sphinx docs
 
     def __getattr__(self, name): # "from htmltag import a" <--*name* will be 'a'
-        # This is how Python looks up the module name
-        if name not in self.__dict__: # So we don't overwrite what's already set
-            # Make our instance of TagWrap exist so we can return it properly
-            setattr(self, name, TagWrap(name))
-        return self.__dict__[name]
+        # This is how Python looks up the module name.  It only gets called
+        # when *name* doesn't exist yet; setdefault() makes sure that all the
+        # threads that get here at the same time end up with the same TagWrap
+        # (without needing a lock).
+        return self.__dict__.setdefault(name, TagWrap(name))
 
     def __call__(self, *args, **kwargs):
         # This turns the 'a' in "from htmltag import a" into a callable:
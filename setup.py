@@ -17,7 +17,7 @@ setup(
     author_email="daniel.mcdougall@liftoffsoftware.com",
     url="https://github.com/liftoff/htmltag",
     license="Apache 2.0",
-    py_modules=["htmltag"],
+    py_modules=["htmltag", "_htmltag_async"],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",